@@ -1 +1,5 @@
 from samp4jhv.samp4jhv import *
+from samp4jhv.map_server import *
+from samp4jhv.map_cache import *
+from samp4jhv.tmp_storage import *
+from samp4jhv.fits_encoding import *
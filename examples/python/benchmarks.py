@@ -0,0 +1,437 @@
+""" Benchmarks of samp4jhv functionality. Run with `python benchmarks.py [name ...]`, without names all benchmarks run. """
+import os
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+
+
+def _timed(func, *args, repeat=3, **kwargs):
+    # returns the best wall-clock time in seconds of repeat runs and the result of the last run
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def _synthetic_map(shape=(2048, 2048)):
+    from sunpy.map import Map
+
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    data = 1e3 * np.exp(-((x - shape[1] / 2) ** 2 + (y - shape[0] / 2) ** 2) / (shape[0] / 4) ** 2)
+    data += rng.normal(0, 5, shape)
+    header = {
+        "CTYPE1": "HPLN-TAN", "CTYPE2": "HPLT-TAN", "CUNIT1": "arcsec", "CUNIT2": "arcsec",
+        "CDELT1": 0.6, "CDELT2": 0.6, "CRPIX1": shape[1] / 2, "CRPIX2": shape[0] / 2, "CRVAL1": 0, "CRVAL2": 0,
+        "DATE-OBS": "2017-09-10T15:01:33", "TELESCOP": "SYNTHETIC", "WAVELNTH": 304, "WAVEUNIT": "angstrom",
+    }
+    return Map(data, header)
+
+
+def benchmark_encodings():
+    """ bytes written and wall-clock time of the FITS encodings of `encode_map` """
+    from samp4jhv.samp4jhv import _save_map
+
+    m = _synthetic_map()
+    encodings = {
+        "default (m.save)": None,
+        "float32": {"dtype": "float32"},
+        "int16": {"dtype": "int16"},
+        "RICE_1 int16": {"compression": "RICE_1", "dtype": "int16"},
+        "GZIP_1 float32": {"compression": "GZIP_1", "dtype": "float32"},
+        "downsample 2 float32": {"downsample": 2, "dtype": "float32"},
+    }
+    print(f"{'encoding':24} {'bytes':>12} {'seconds':>8}")
+    with TemporaryDirectory() as tmp:
+        for name, encoding in encodings.items():
+            filename = os.path.join(tmp, name.replace(" ", "_") + ".fits")
+
+            def write():
+                if os.path.exists(filename):
+                    os.unlink(filename)
+                _save_map(m, filename, encoding)
+
+            seconds, _ = _timed(write)
+            print(f"{name:24} {os.path.getsize(filename):12d} {seconds:8.3f}")
+
+
+def _synthetic_flare_list(n_rows=20000):
+    # returns a record array with the columns of a RHESSI flare list fits file and the flag ids
+    from astropy.io import fits
+    from samp4jhv.ext.rhessi.flares import FLAGID2FLAG
+
+    rng = np.random.default_rng(0)
+    flag_ids = list(FLAGID2FLAG)
+    start = np.sort(rng.uniform(7.0e8, 1.2e9, n_rows))
+    duration = rng.uniform(60, 3600, n_rows)
+    flags = rng.integers(0, 2, (n_rows, len(flag_ids)), dtype=np.uint8)
+    flags[:, flag_ids.index('ATT_STATE_AT_PEAK')] = rng.integers(0, 4, n_rows)
+    flags[:, flag_ids.index('DATA_QUALITY')] = rng.integers(0, 12, n_rows)
+    columns = [
+        fits.Column("ID_NUMBER", "J", array=np.arange(n_rows)),
+        fits.Column("START_TIME", "D", array=start),
+        fits.Column("END_TIME", "D", array=start + duration),
+        fits.Column("PEAK_TIME", "D", array=start + duration / 3),
+        fits.Column("PEAK_COUNTRATE", "E", array=rng.uniform(0, 1e4, n_rows)),
+        fits.Column("TOTAL_COUNTS", "E", array=rng.uniform(0, 1e7, n_rows)),
+        fits.Column("ENERGY_HI", "2E", array=np.tile([6, 12], (n_rows, 1))),
+        fits.Column("POSITION", "2E", array=rng.uniform(-1000, 1000, (n_rows, 2))),
+        fits.Column("ACTIVE_REGION", "J", array=rng.integers(0, 2000, n_rows)),
+        fits.Column("FLAGS", f"{len(flag_ids)}B", array=flags),
+    ]
+    return fits.FITS_rec.from_columns(columns), flag_ids
+
+
+def _legacy_convert_flag_dict(flags_dict):
+    # formats the flags of a single flare, as done before vectorization
+    from samp4jhv.ext.rhessi.flares import FLAGID2FLAG
+
+    flags = []
+    for k in flags_dict:
+        if flags_dict[k] > 0 and FLAGID2FLAG[k] != '':
+            if k.startswith('ATTEN_') and int(k[-1:]) == flags_dict['ATT_STATE_AT_PEAK']:
+                flags.append(FLAGID2FLAG[k].upper())
+            else:
+                flags.append(FLAGID2FLAG[k].replace("n", str(flags_dict[k])))
+    flags.sort(key=str.lower)
+    return flags
+
+
+def _legacy_derived_columns(d, flag_ids):
+    # per-row implementation of FLAGS, FLAGS_FORMATTED, DURATION and POS_RADIAL before vectorization
+    rd = {}
+    rd['FLAGS'] = [{fid: j for (j, fid) in zip(d[i]['FLAGS'], flag_ids)} for i in range(len(d))]
+    rd["FLAGS_FORMATTED"] = [" ".join(_legacy_convert_flag_dict(dct)) for dct in rd['FLAGS']]
+    rd['DURATION'] = [int(round(d[i]['END_TIME'] - d[i]['START_TIME'])) for i in range(len(d))]
+    rd['POS_RADIAL'] = [int(round((d[i]['POSITION'][0] ** 2 + d[i]['POSITION'][1] ** 2) ** 0.5)) for i in range(len(d))]
+    return rd
+
+
+def benchmark_read_flare_list():
+    """ per-row vs. whole-column computation of derived flare list columns """
+    from samp4jhv.ext.rhessi.flares import _parse_flare_list, _flags_formatted
+
+    for n_rows in (1000, 20000):
+        d, flag_ids = _synthetic_flare_list(n_rows)
+        legacy_seconds, legacy = _timed(_legacy_derived_columns, d, flag_ids, repeat=1)
+        seconds, df = _timed(_parse_flare_list, d, flag_ids)
+        for k in ("DURATION", "POS_RADIAL"):
+            assert legacy[k] == df[k].tolist(), k
+        assert legacy["FLAGS_FORMATTED"] == _flags_formatted(df).tolist()
+        print(f"{n_rows:6d} rows: per-row {legacy_seconds:7.3f} s (derived columns only), "
+              f"vectorized {seconds:7.3f} s (whole frame)")
+
+        flags_seconds, _ = _timed(_flags_formatted, df)
+        print(f"{'':6} formatting all flags on demand {flags_seconds:7.3f} s, "
+              f"memory of flag columns {df[flag_ids].memory_usage(index=False).sum()} bytes")
+
+
+def benchmark_concat_flare_lists():
+    """ accumulating monthly flare lists one by one (former DataFrame.append) vs. a single concat """
+    import pandas as pd
+    from samp4jhv.ext.rhessi.flares import _parse_flare_list
+
+    d, flag_ids = _synthetic_flare_list(600)  # a busy month
+    month = _parse_flare_list(d, flag_ids)
+    for n_months in (1, 12, 200):
+        months = [month] * n_months
+
+        def append_each():
+            result = pd.DataFrame()
+            for m in months:
+                result = pd.concat([result, m], ignore_index=True)
+            return result
+
+        append_seconds, _ = _timed(append_each, repeat=1)
+        concat_seconds, _ = _timed(pd.concat, months, ignore_index=True)
+        print(f"{n_months:4d} months: append one by one {append_seconds:7.3f} s, single concat {concat_seconds:7.3f} s")
+
+
+def benchmark_print_flare_list():
+    """ per-row formatting with iterrows vs. bulk rendering of the .txt flare list """
+    import io
+    from samp4jhv.ext.rhessi.flares import _parse_flare_list, _flags_formatted, write_flare_list
+
+    d, flag_ids = _synthetic_flare_list(10000)  # about a year of flares
+    df = _parse_flare_list(d, flag_ids)
+
+    def legacy():
+        out = io.StringIO()
+        for (idx, row), flags in zip(df.iterrows(), _flags_formatted(df)):
+            print(
+                "{id:9} {st} {pt} {et} {dur:5} {peak:6} {n:9} {e:>11} {x:5} {y:5} {r:6} {ar:4}  {flags}".format(
+                    id=row['ID_NUMBER'],
+                    st=row['START_TIME'].strftime('%e-%b-%Y %H:%M:%S'),
+                    pt=row['PEAK_TIME'].strftime('%H:%M:%S'),
+                    et=row['END_TIME'].strftime('%H:%M:%S'),
+                    dur=row['DURATION'],
+                    peak=int(row['PEAK_COUNTRATE']),
+                    n=int(row['TOTAL_COUNTS']),
+                    e=str(int(row['ENERGY_HI'][0])) + "-" + str(int(row['ENERGY_HI'][1])),
+                    x=int(round(row['POSITION'][0])),
+                    y=int(round(row['POSITION'][1])),
+                    r=int(round(row['POS_RADIAL'])),
+                    ar=row['ACTIVE_REGION'],
+                    flags=flags,
+                ), file=out
+            )
+        return out.getvalue()
+
+    def bulk():
+        out = io.StringIO()
+        write_flare_list(df, out)
+        return out.getvalue()
+
+    legacy_seconds, expected = _timed(legacy, repeat=1)
+    seconds, text = _timed(bulk)
+    assert text == expected
+    print(f"{len(df)} flares: iterrows {legacy_seconds:7.3f} s, bulk {seconds:7.3f} s")
+
+
+def _synthetic_image_cube(filename, n_times=40, n_energies=6, size=256):
+    # writes a RHESSI-like 4D image cube (time, energy, y, x) with its time and energy axes
+    from astropy.io import fits
+
+    rng = np.random.default_rng(0)
+    header = fits.Header({
+        "CTYPE1": "HPLN-TAN", "CTYPE2": "HPLT-TAN", "CUNIT1": "arcsec", "CUNIT2": "arcsec",
+        "CDELT1": 1.0, "CDELT2": 1.0, "CRPIX1": size / 2, "CRPIX2": size / 2, "CRVAL1": 900.0, "CRVAL2": 200.0,
+        "CROTACN1": 0.0, "CROTACN2": 0.0, "CROTA": 0.0, "TELESCOP": "RHESSI", "INSTRUME": "RHESSI",
+        "DATE_OBS": "2002-02-20T11:06:00.000",
+    })
+    data = rng.random((n_times, n_energies, size, size), dtype=np.float32)
+    start = 7.2e8 + 20.0 * np.arange(n_times)
+    time_axis = np.stack([start, start + 20.0], axis=1)
+    energy_axis = np.stack([np.geomspace(3, 100, n_energies + 1)[:-1], np.geomspace(3, 100, n_energies + 1)[1:]], axis=1)
+    axes = fits.BinTableHDU.from_columns([
+        fits.Column("TIME_AXIS", f"{2 * n_times}D", dim=f"(2,{n_times})", array=time_axis[np.newaxis]),
+        fits.Column("ENERGY_AXIS", f"{2 * n_energies}E", dim=f"(2,{n_energies})", array=energy_axis[np.newaxis]),
+    ])
+    fits.HDUList([fits.PrimaryHDU(data, header=header), axes]).writeto(filename, overwrite=True)
+
+
+def _peak_rss(func, *args):
+    # returns wall-clock seconds, peak resident set size in bytes and a summary of the maps of func(*args),
+    # run in a fresh process so the peak is not inherited. Unlike tracemalloc, the resident set size
+    # includes the pages of memory-mapped files
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_run_measured, func, *args).result()
+
+
+def _run_measured(func, *args):
+    import hashlib
+    import resource
+    import sunpy.map  # noqa: F401, same imports before both runs
+
+    start = perf_counter()
+    maps = func(*args)
+    seconds = perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    keywords = ("energy_l", "energy_h", "datamin", "datamax", "date_obs", "date_end")
+    summary = {band: [(hashlib.sha1(np.ascontiguousarray(m.data).tobytes()).hexdigest(),
+                       [float(m.meta[k]) if k.startswith(("energy", "data")) else str(m.meta[k]) for k in keywords])
+                      for m in band_maps]
+               for band, band_maps in maps.items()}
+    return seconds, peak, summary
+
+
+def _legacy_hsi_fits2map(url):
+    # hsi_fits2map before memory-mapping: reads the whole cube, per-frame min/max and a full header per map
+    from sunpy.io.fits import read
+    from sunpy.map import Map
+    from samp4jhv.ext.rhessi.utime import utime_to_isot
+
+    f = read(url)
+    header = f[0].header
+    del header["CROTACN1"]
+    del header["CROTACN2"]
+    del header["CROTA"]
+
+    d_min = {}
+    d_max = {}
+    for e in range(len(f[1].data[0]["ENERGY_AXIS"])):
+        d_min[e] = 1e10
+        d_max[e] = -1e10
+        for t in range(len(f[1].data[0]["TIME_AXIS"])):
+            d_min[e] = min(d_min[e], f[0].data[t][e].min())
+            d_max[e] = max(d_max[e], f[0].data[t][e].max())
+
+    time_axis = f[1].data[0]["TIME_AXIS"]
+    date_obs = utime_to_isot(time_axis[:, 0])
+    date_end = utime_to_isot(time_axis[:, 1])
+
+    maps = {}
+    for e in range(len(f[1].data[0]["ENERGY_AXIS"])):
+        header["ENERGY_L"] = f[1].data[0]["ENERGY_AXIS"][e][0]
+        header["ENERGY_H"] = f[1].data[0]["ENERGY_AXIS"][e][1]
+        header["DATAMIN"] = d_min[e]
+        header["DATAMAX"] = d_max[e]
+        key = f"{int(header['ENERGY_L'])}-{int(header['ENERGY_H'])} keV"
+        maps[key] = []
+        for t in range(len(f[1].data[0]["TIME_AXIS"])):
+            header["DATE_OBS"] = str(date_obs[t])
+            header["DATE_END"] = str(date_end[t])
+            maps[key].append(Map(f[0].data[t][e], header))
+    return maps
+
+
+def benchmark_hsi_fits2map():
+    """ hsi_fits2map before (whole cube read, per-frame min/max) vs. after (memory-mapped, one reduction), peak RSS in a fresh process """
+    from samp4jhv.ext.rhessi.hsi_fits2map import hsi_fits2map
+
+    with TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "cube.fits")
+        _synthetic_image_cube(filename)
+        print(f"cube file: {os.path.getsize(filename) / 2**20:.0f} MiB")
+
+        results = {}
+        for name, func in (("before", _legacy_hsi_fits2map), ("after", hsi_fits2map)):
+            seconds, peak, results[name] = _peak_rss(func, filename)
+            print(f"hsi_fits2map {name:7} {seconds:7.3f} s, peak RSS {peak / 2**20:7.1f} MiB")
+        assert results["before"] == results["after"], "maps differ"
+
+
+def benchmark_frame_headers():
+    """ per-frame allocation of a full header copy per map vs. base header plus per-frame keywords """
+    import tracemalloc
+    from sunpy.map import Map
+    from samp4jhv.ext.rhessi.hsi_fits2map import HSIImageCube
+
+    def allocated(func):
+        # returns bytes still allocated by the result of func and the result itself
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return after - before, result
+
+    with TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "cube.fits")
+        _synthetic_image_cube(filename, n_times=100, n_energies=4, size=64)
+        cube = HSIImageCube(filename)
+        n_frames = len(cube)
+        cube.to_dict()  # compute value ranges upfront, they are not part of the comparison
+
+        def header_copies():
+            # former approach: full copy of the header for every frame
+            headers = []
+            for e in range(cube.shape[0]):
+                for t in range(cube.shape[1]):
+                    header = dict(cube.base_header)
+                    header.update(cube.frame(e, t).keywords)
+                    headers.append(header)
+            return headers
+
+        def frames():
+            return [frame for e in range(cube.shape[0]) for frame in cube.frames(e)]
+
+        for name, func in (("full header copies", header_copies), ("base header + keywords", frames)):
+            size, result = allocated(func)
+            seconds, _ = _timed(func)
+            print(f"{name:24} {size / n_frames:9.0f} bytes per frame, {seconds / n_frames * 1e6:7.1f} us per frame")
+            del result
+
+        m = cube[0, 0]
+        frame = cube.frame(0, 0)
+        out = os.path.join(tmp, "frame.fits")
+        for name, func in (("Map + m.save", lambda: Map(m.data, m.meta).save(out, overwrite=True)),
+                           ("HSIFrame.save", lambda: frame.save(out, overwrite=True))):
+            seconds, _ = _timed(func, repeat=20)
+            print(f"{name:24} {seconds * 1e3:9.2f} ms per FITS write")
+
+
+def _legacy_matching_chars(s1, s2):
+    # former per-character scoring of image_cubes._matching_chars
+    m_len = min(len(s1), len(s2))
+    if m_len < 18:
+        return 0
+    scores = [2] * m_len
+    scores[11], scores[12], scores[16], scores[17] = 1, 1, 1, 1
+    return sum(scores[i] for i in range(m_len) if s1[i] == s2[i])
+
+
+def benchmark_archive_listings(n_files=5000):
+    """ parsing and matching an image cube archive listing: BeautifulSoup and per-character loops vs. href regex and code point matrix """
+    from samp4jhv.ext.rhessi.image_cubes import _Listing, _matching_chars, _parse_hrefs
+
+    rows = "".join(f'<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td>'
+                   f'<td><a href="hsi_imagecube_clean_20020220_{i // 60 % 24:02d}{i % 60:02d}_{i % 97:03d}.fits">'
+                   f'hsi_imagecube_clean_20020220_{i // 60 % 24:02d}{i % 60:02d}_{i % 97:03d}.fits</a></td>'
+                   f'<td align="right">2021-03-02 11:52  </td><td align="right">2.1M</td></tr>\n'
+                   for i in range(n_files))
+    page = (f'<html><head><title>Index of /imagecube_fits</title></head><body><table>'
+            f'<tr><th><a href="?C=N;O=D">Name</a></th></tr><tr><td><a href="/rhessi_extras/">Parent</a></td></tr>'
+            f'{rows}</table></body></html>').encode()
+    expected = "hsi_imagecube_clean_20020220_1106_"
+
+    def legacy():
+        from bs4 import BeautifulSoup
+        hrefs = [a.get("href") for a in BeautifulSoup(page.decode(), "html.parser").find_all("a")]
+        return max(hrefs, key=lambda h: _legacy_matching_chars(h, expected) if h.endswith(".fits") else 0)
+
+    def vectorized():
+        listing = _Listing(_parse_hrefs(page))
+        scores = _matching_chars(listing, expected)
+        return listing.hrefs[int(np.argmax(scores))]
+
+    for name, func in (("BeautifulSoup + loops", legacy), ("regex + code points", vectorized)):
+        seconds, match = _timed(func)
+        print(f"{name:24} {seconds * 1e3:9.2f} ms for {n_files} files, match {match}")
+
+
+def benchmark_limb_flares(n_flares=120000):
+    """ cross-matching a mission-sized flare list with the limb flare catalogue: per-flare loop vs. searchsorted """
+    import bisect
+    from datetime import timedelta
+    import pandas as pd
+    from samp4jhv.ext.rhessi.limb_flares import calc_is_limb_flare, read_limb_flares
+
+    rng = np.random.default_rng(0)
+    limb_flares = read_limb_flares()
+    mission = np.array(["2002-02-12", "2018-08-16"], dtype="datetime64[s]").astype(np.int64)
+    start = np.sort(rng.integers(mission[0], mission[1], n_flares)).astype("datetime64[s]").astype("datetime64[ns]")
+    df = pd.DataFrame({
+        "START_TIME": start,
+        "END_TIME": start + rng.integers(60, 3600, n_flares).astype("timedelta64[s]"),
+        "POS_RADIAL": rng.integers(0, 1000, n_flares),
+    })
+    tolerance = timedelta(minutes=5)
+
+    def per_flare():
+        times = sorted(limb_flares)
+        return [bisect.bisect_right(times, e + tolerance) > bisect.bisect_left(times, s - tolerance) or r >= 900
+                for s, e, r in zip(df["START_TIME"].dt.to_pydatetime(), df["END_TIME"].dt.to_pydatetime(),
+                                   df["POS_RADIAL"])]
+
+    legacy_seconds, legacy = _timed(per_flare, repeat=1)
+    seconds, result = _timed(calc_is_limb_flare, df, limb_flares, tolerance)
+    assert legacy == result["IS_LIMB_FLARE"].tolist()
+    print(f"{n_flares} flares, {len(limb_flares)} limb flares: per-flare {legacy_seconds:7.3f} s, "
+          f"vectorized {seconds:7.3f} s, {int(result['IS_LIMB_FLARE'].sum())} limb flares")
+
+
+BENCHMARKS = {
+    "encodings": benchmark_encodings,
+    "read_flare_list": benchmark_read_flare_list,
+    "concat_flare_lists": benchmark_concat_flare_lists,
+    "print_flare_list": benchmark_print_flare_list,
+    "hsi_fits2map": benchmark_hsi_fits2map,
+    "frame_headers": benchmark_frame_headers,
+    "archive_listings": benchmark_archive_listings,
+    "limb_flares": benchmark_limb_flares,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"# {name}: {BENCHMARKS[name].__doc__.strip()}")
+        BENCHMARKS[name]()
+        print()
@@ -2,3 +2,5 @@ from samp4jhv.ext.rhessi.flares import *
 from samp4jhv.ext.rhessi.hsi_fits2map import *
 from samp4jhv.ext.rhessi.limb_flares import *
 from samp4jhv.ext.rhessi.image_cubes import *
+from samp4jhv.ext.rhessi.pipeline import *
+from samp4jhv.ext.rhessi.utime import *
@@ -1,17 +1,28 @@
+import os
+import io
+import sys
+import json
+import hashlib
 import warnings
 import pandas as pd
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from time import time
 from dateutil.relativedelta import relativedelta
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
 
 import sunpy.io.fits
-from sunpy.time import parse_time
+
+from samp4jhv.ext.rhessi.utime import utime_to_datetime64
 
 
 __all__ = [
-    "get_flare_list", "read_flare_list_file", "print_flare_list","filter_flares_by_time", "KNOWN_FLARE_LIST_SOURCES"
+    "get_flare_list", "iter_flare_list", "read_flare_list_file", "print_flare_list", "write_flare_list","filter_flares_by_time", "filter_flares_by_flags",
+    "FlareIndex", "KNOWN_FLARE_LIST_SOURCES"
 ]
 
 
@@ -55,7 +66,8 @@ FLAGID2FLAG = {
 }
 
 
-def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m.fits", inc=relativedelta(months=+1)):
+def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m.fits", inc=relativedelta(months=+1),
+                   max_workers=8, cache_dir=None, max_age=86400):
     """
     Read and combine RHESSI flare lists from .fits files as specified with further parameters
     Dates are allowed in the following formats:
@@ -78,6 +90,16 @@ def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m
     inc : `timedelta`, `relativedelta`, optional
         Specifies by how much time the single files are separated.
         Defaults to ``relativedelta(months=+1)``.
+    max_workers : `int`, optional
+        Number of files that are downloaded and parsed concurrently.
+        Defaults to ``8``.
+    cache_dir : `str`, optional
+        Folder to keep parsed files in. Cached files are only read again if they changed at the source
+        (ETag, Last-Modified or size for URLs, modification time and size for local files).
+        Defaults to ``None`` (no caching).
+    max_age : `float`, optional
+        Seconds during which cached files are used without checking the source for changes.
+        Defaults to ``86400`` (one day).
 
     Returns
     -------
@@ -85,6 +107,66 @@ def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m
         out : ``pandas.DataFrame`` containing the flares within the given time constraints
     """
 
+    start_dt, end_dt = _time_bounds(start, end)
+    files = _flare_list_files(start_dt, end_dt, source, file_format, inc)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    read = partial(_read_flare_list_file_or_error, cache_dir=cache_dir, max_age=max_age)
+
+    monthly_flares = []
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # results are in the order of the files, i.e. chronological
+        for file, flares in zip(files, executor.map(read, files)):
+            flares = _skip_missing(file, flares)
+            if flares is not None:
+                monthly_flares.append(flares)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    if not monthly_flares:
+        return pd.DataFrame()
+    result = pd.concat(monthly_flares, ignore_index=True)  # single copy instead of one per file
+
+    # filter results for more detailed time constraints (if applicable)
+    left_bound = result['END_TIME'].searchsorted(start_dt, 'left')  # END_TIME >= start_dt
+    right_bound = result['START_TIME'].searchsorted(end_dt, 'right')  # START_TIME <= end_dt  (inclusive)
+    return result[left_bound:right_bound]
+
+
+def iter_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m.fits", inc=relativedelta(months=+1),
+                    columns=None, cache_dir=None, max_age=86400):
+    """
+    Read RHESSI flare lists lazily, one file after another. Only the files within the given time constraints
+    are read, rows outside of them are dropped before they are converted, and only the requested columns
+    are built. Memory usage is therefore bounded by a single file, e.g. for scans over the whole mission.
+    See `get_flare_list` for a description of the parameters not listed here.
+
+    Parameters
+    ----------
+    columns : `list`, optional
+        Columns to load, e.g. ``["START_TIME", "END_TIME", "POS_RADIAL", "SAA_AT_START"]``.
+        Defaults to ``None`` (all columns).
+
+    Yields
+    ------
+    ``pandas.DataFrame``
+        out : ``pandas.DataFrame`` containing the flares of one file within the given time constraints
+    """
+    start_dt, end_dt = _time_bounds(start, end)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    for file in _flare_list_files(start_dt, end_dt, source, file_format, inc):
+        flares = _read_flare_list_file_or_error(file, cache_dir, max_age, columns, (start_dt, end_dt))
+        flares = _skip_missing(file, flares)
+        if flares is not None:
+            yield flares
+
+
+def _time_bounds(start, end):
+    # parses start and end date, the end date is inclusive, i.e. the end of the given month or day
     formats = {
         5: "%y-%m",  # YY-mm
         6: "%Y%m",  # YYYYmm
@@ -99,6 +181,15 @@ def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m
     except (KeyError, ValueError):
         raise ValueError("invalid datetime")
 
+    if len(end) < 8:
+        end_dt += relativedelta(months=+1, microseconds=-1)  # add month -1ms to address inclusive right bound
+    elif len(end) <= 10:
+        end_dt += relativedelta(days=+1, microseconds=-1)  # add day if end date was specified on a day-basis
+    return start_dt, end_dt
+
+
+def _flare_list_files(start_dt, end_dt, source, file_format, inc):
+    # returns the locations of all files between start_dt and end_dt in chronological order
     format_str = file_format[file_format.index("%"):file_format.rindex("%") + 2]
     cur_format = start_dt.strftime(format_str)
     end_format = end_dt.strftime(format_str)
@@ -107,44 +198,43 @@ def get_flare_list(start, end, source='NASA', file_format="hessi_flare_list_%Y%m
         source = KNOWN_FLARE_LIST_SOURCES[source]
 
     cur_dt = start_dt
-    result = pd.DataFrame()
+    files = []
     while cur_format <= end_format:
-        file = file_format.replace(format_str, cur_format)
+        files.append(source + file_format.replace(format_str, cur_format))
         cur_dt = cur_dt + inc
         cur_format = cur_dt.strftime(format_str)
+    return files
 
-        # allow missing files with a warning, e.g. there is no file for 2014-07
-        try:
-            result = result.append(read_flare_list_file(source + file), ignore_index=True)
-        except HTTPError as e:
-            if e.code == 404:
-                warnings.warn("Skipped: " + file + " (" + str(e.code) + " " + e.msg + ")")
-            else:
-                raise
-        except FileNotFoundError as e:
-            warnings.warn("Skipped: " + file + " (file not found)")
-
-    # filter results for more detailed time constraints (if applicable)
-    if len(end) < 8:
-        end_dt += relativedelta(months=+1, microseconds=-1)  # add month -1ms to address inclusive right bound
-    elif len(end) <= 10:
-        end_dt += relativedelta(days=+1, microseconds=-1)  # add day if end date was specified on a day-basis
 
-    left_bound = result['END_TIME'].searchsorted(start_dt, 'left')  # END_TIME >= start_dt
-    right_bound = result['START_TIME'].searchsorted(end_dt, 'right')  # START_TIME <= end_dt  (inclusive)
-    return result[left_bound:right_bound]
+def _skip_missing(file, flares):
+    # allow missing files with a warning, e.g. there is no file for 2014-07
+    name = os.path.basename(file)
+    if isinstance(flares, HTTPError):
+        if flares.code != 404:
+            raise flares
+        warnings.warn("Skipped: " + name + " (" + str(flares.code) + " " + flares.msg + ")")
+        return None
+    if isinstance(flares, FileNotFoundError):
+        warnings.warn("Skipped: " + name + " (file not found)")
+        return None
+    return flares
 
 
-def read_flare_list_file(file):
+def read_flare_list_file(file, columns=None, time_range=None):
     """
     Read RHESSI flare list .fits file into ``pandas.DataFrame``.
     TIME values are parsed with format 'utime', which is the same as Unix timestamp but starts 9 years later.
-    FLAGS are assigned their respective label (FLAG ID) and returned as `dict`.
+    FLAGS are split into one integer column per flag, named by its label (FLAG ID), e.g. ``SAA_AT_START``.
 
     Parameters
     ----------
     file : `str`
         The URL or local filename of the hessi flare list.
+    columns : `list`, optional
+        Columns to build. Defaults to ``None`` (all columns).
+    time_range : `tuple`, optional
+        Only flares with END_TIME >= ``time_range[0]`` and START_TIME <= ``time_range[1]`` (`datetime`) are
+        converted. Defaults to ``None`` (all flares).
 
     Returns
     -------
@@ -156,24 +246,133 @@ def read_flare_list_file(file):
     https://hesperia.gsfc.nasa.gov/rhessi3/data-access/rhessi-data/flare-list/index.html
     """
     fits = sunpy.io.fits.read(file)
-    d = fits[3].data
+    return _parse_flare_list(fits[3].data, list(fits[2].data['FLAG_IDS'][0]), columns, time_range)
+
+
+def _parse_flare_list(d, flag_ids, columns=None, time_range=None):
+    # converts the flare list record array d into a DataFrame, all columns are computed as a whole
+    if time_range is not None:
+        utime_epoch = datetime(1979, 1, 1)
+        keep = (d['END_TIME'] >= (time_range[0] - utime_epoch).total_seconds()) & \
+               (d['START_TIME'] <= (time_range[1] - utime_epoch).total_seconds())
+        d = d[keep]
+
+    def wanted(k):
+        return columns is None or k in columns
+
     rd = {}  # result dict
     for k in d.columns.names:
-        if k in ["BCK_TIME", "IMAGE_TIME", "START_TIME", "END_TIME", "PEAK_TIME"]:
-            rd[k] = parse_time(d[k], format="utime").to_value('datetime').tolist()
-        elif k == 'FLAGS':
-            rd[k] = [{fid: j for (j, fid) in zip(d[i][k], fits[2].data['FLAG_IDS'][0])} for i in range(len(d))]
-            rd["FLAGS_FORMATTED"] = [" ".join(_convert_flag_dict(dct)) for dct in rd['FLAGS']]
+        if k == 'FLAGS':
+            flags = np.asarray(d[k])
+            for j, fid in enumerate(flag_ids):
+                if wanted(fid):
+                    rd[fid] = flags[:, j]
+        elif not wanted(k):
+            continue
+        elif k in ["BCK_TIME", "IMAGE_TIME", "START_TIME", "END_TIME", "PEAK_TIME"]:
+            rd[k] = utime_to_datetime64(d[k])
         elif k in ["FILENAME", "GOES_CLASS", "ALT_ID"]:
             rd[k] = np.char.strip(d[k]).tolist()
         else:
             rd[k] = d[k].tolist()
 
     # add reformatted and calculated fields
-    rd['DURATION'] = [int(round(d[i]['END_TIME'] - d[i]['START_TIME'])) for i in range(len(d))]
-    rd['POS_RADIAL'] = [int(round((d[i]['POSITION'][0] ** 2 + d[i]['POSITION'][1] ** 2) ** 0.5)) for i in range(len(d))]
+    if wanted('DURATION'):
+        rd['DURATION'] = np.round(d['END_TIME'] - d['START_TIME']).astype(int).tolist()
+    if wanted('POS_RADIAL'):
+        position = np.asarray(d['POSITION'], dtype=np.float64)  # float32 in the file, round in float64 as before
+        rd['POS_RADIAL'] = np.round((position[:, 0] ** 2 + position[:, 1] ** 2) ** 0.5).astype(int).tolist()
+
+    result = pd.DataFrame.from_dict(rd)
+    return result if columns is None else result[list(columns)]
+
 
-    return pd.DataFrame.from_dict(rd)
+def _read_flare_list_file_or_error(file, cache_dir=None, max_age=86400, columns=None, time_range=None):
+    # errors of missing files are returned instead of raised to be handled in the order of the files
+    try:
+        if cache_dir is None:
+            return read_flare_list_file(file, columns, time_range)
+        flares = _read_flare_list_file_cached(file, cache_dir, max_age)
+    except (HTTPError, FileNotFoundError) as e:
+        return e
+
+    if time_range is not None:
+        flares = flares[(flares['END_TIME'] >= time_range[0]) & (flares['START_TIME'] <= time_range[1])]
+    return flares if columns is None else flares[list(columns)]
+
+
+def _read_flare_list_file_cached(file, cache_dir, max_age):
+    # reads a parsed flare list from cache_dir, or from the source if it is not cached or changed
+    name = f"{os.path.basename(file)}.{hashlib.sha1(file.encode()).hexdigest()[:16]}"
+    data_file = os.path.join(cache_dir, name + ".npz")
+    meta_file = os.path.join(cache_dir, name + ".json")
+
+    meta = None
+    if os.path.isfile(data_file) and os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if time() - meta["checked"] < max_age:
+            return _read_columns(data_file)
+
+    try:
+        validator = _source_validator(file)
+    except (HTTPError, FileNotFoundError):
+        raise
+    except (URLError, OSError):
+        if meta is None:
+            raise
+        return _read_columns(data_file)  # source not reachable, use cached file
+
+    if meta is not None and validator is not None and validator == meta["validator"]:
+        flares = _read_columns(data_file)
+    else:
+        flares = read_flare_list_file(file)
+        tmp_file = f"{data_file}.{os.getpid()}.tmp"
+        _write_columns(flares, tmp_file)
+        os.replace(tmp_file, data_file)
+
+    tmp_file = f"{meta_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"source": file, "checked": time(), "validator": validator}, f)
+    os.replace(tmp_file, meta_file)
+    return flares
+
+
+def _write_columns(flares, filename):
+    # stores the columns as plain arrays, so loading never unpickles objects (see `_read_columns`):
+    # strings as unicode arrays, columns of lists (e.g. POSITION) as 2D arrays
+    arrays = {}
+    for c, values in flares.items():
+        values = values.to_numpy()
+        if values.dtype == object:
+            first = values[0] if len(values) else ""
+            values = np.array(values.tolist()) if isinstance(first, (list, tuple)) else values.astype(str)
+        if values.dtype == object:
+            raise ValueError(f"column {c} can not be cached as plain array")
+        arrays[c] = values
+    with open(filename, "wb") as f:
+        np.savez(f, __columns__=np.array(list(flares.columns), dtype=str), **arrays)
+
+
+def _read_columns(filename):
+    rd = {}
+    with np.load(filename, allow_pickle=False) as arrays:
+        columns = arrays["__columns__"].tolist()
+        for c in columns:
+            values = arrays[c]
+            rd[c] = values.tolist() if values.ndim > 1 or values.dtype.kind == "U" else values
+    return pd.DataFrame(rd, columns=columns)
+
+
+def _source_validator(file):
+    # returns values that change whenever the source file changes or None if there are none
+    if "://" not in file:
+        stat = os.stat(file)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    with urlopen(Request(file, method="HEAD"), timeout=30) as response:
+        validator = {k: response.headers[k] for k in ("ETag", "Last-Modified", "Content-Length") if k in response.headers}
+    return validator or None
 
 
 def print_flare_list(data_frame):
@@ -186,52 +385,245 @@ def print_flare_list(data_frame):
         DataFrame containing the flares to print.
     """
 
-    for idx, row in data_frame.iterrows():
-        print(
-            "{id:9} {st} {pt} {et} {dur:5} {peak:6} {n:9} {e:>11} {x:5} {y:5} {r:6} {ar:4}  {flags}".format(
-                id=row['ID_NUMBER'],
-                st=row['START_TIME'].strftime('%e-%b-%Y %H:%M:%S'),
-                pt=row['PEAK_TIME'].strftime('%H:%M:%S'),
-                et=row['END_TIME'].strftime('%H:%M:%S'),
-                dur=row['DURATION'],
-                peak=int(row['PEAK_COUNTRATE']),
-                n=int(row['TOTAL_COUNTS']),
-                e=str(int(row['ENERGY_HI'][0])) + "-" + str(int(row['ENERGY_HI'][1])),
-                x=int(round(row['POSITION'][0])),
-                y=int(round(row['POSITION'][1])),
-                r=int(round(row['POS_RADIAL'])),
-                ar=row['ACTIVE_REGION'],
-                flags=row['FLAGS_FORMATTED'],
-            )
-        )
+    write_flare_list(data_frame, sys.stdout)
 
 
-def _convert_flag_dict(flags_dict):
+def write_flare_list(data_frame, file, format="txt"):
     """
-    Convert flag dictionary into array of short abbreviations (as in available .txt lists).
+    Write flares in a single write, either formatted as the available .txt flare lists
+    (same output as `print_flare_list`) or as CSV/TSV with the same fields.
 
     Parameters
     ----------
-    flags_dict : `dict`
-        Dictionary containing the flags where key is the flag id and value the value from the byte mask.
+    data_frame : ``pandas.DataFrame``
+        DataFrame containing the flares to write.
+    file : file-like or `str`
+        Text file object or filename to write to.
+    format : `str`, optional
+        ``"txt"``, ``"csv"`` or ``"tsv"``.
+        Defaults to ``"txt"``.
+    """
+    if format not in ("txt", "csv", "tsv"):
+        raise ValueError(f"unknown format: {format}, use one of ['txt', 'csv', 'tsv']")
+    if len(data_frame) == 0:
+        return  # nothing to write, as with print_flare_list
+
+    columns = _render_flare_list_columns(data_frame)
+    if format == "txt":
+        widths = {"ID_NUMBER": 9, "DURATION": 5, "PEAK_COUNTRATE": 6, "TOTAL_COUNTS": 9, "ENERGY_HI": 11,
+                  "X_POSITION": 5, "Y_POSITION": 5, "POS_RADIAL": 6, "ACTIVE_REGION": 4}
+        # one format string for all lines, padding and joining in str.format is much faster than np.char
+        line = " ".join(f"{{:>{widths[k]}}}" if k in widths else "{}" for k in list(columns)[:-1]) + "  {}\n"
+        text = "".join(line.format(*row) for row in zip(*columns.values()))
+    else:
+        buffer = io.StringIO()
+        pd.DataFrame(columns).to_csv(buffer, sep="," if format == "csv" else "\t", index=False)
+        text = buffer.getvalue()
+
+    if isinstance(file, str):
+        with open(file, "w") as f:
+            f.write(text)
+    else:
+        file.write(text)
+
+
+MONTH_ABBREVIATIONS = np.array(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])
+
+
+def _render_flare_list_columns(data_frame):
+    # formats all fields of the .txt flare lists as lists of strings (without padding)
+    def hms(column):
+        # HH:MM:SS, fractions of seconds are dropped as with strftime
+        iso = np.datetime_as_string(data_frame[column].to_numpy(dtype="datetime64[s]"), unit="s")
+        return [t[11:19] for t in iso.tolist()]
+
+    def integers(values):
+        return np.asarray(values).astype(np.int64).astype(str).tolist()
+
+    start = data_frame['START_TIME'].dt
+    energy = np.array(data_frame['ENERGY_HI'].tolist(), dtype=float).reshape(-1, 2)
+    position = np.array(data_frame['POSITION'].tolist(), dtype=float).reshape(-1, 2)
+
+    # same as strftime('%e-%b-%Y %H:%M:%S')
+    start_time = [f"{d:>2}-{m}-{y} {t}" for d, m, y, t in zip(integers(start.day),
+                                                              MONTH_ABBREVIATIONS[start.month.to_numpy() - 1].tolist(),
+                                                              integers(start.year), hms('START_TIME'))]
+
+    return {
+        "ID_NUMBER": integers(data_frame['ID_NUMBER']),
+        "START_TIME": start_time,
+        "PEAK_TIME": hms('PEAK_TIME'),
+        "END_TIME": hms('END_TIME'),
+        "DURATION": integers(data_frame['DURATION']),
+        "PEAK_COUNTRATE": integers(data_frame['PEAK_COUNTRATE']),  # truncated as int()
+        "TOTAL_COUNTS": integers(data_frame['TOTAL_COUNTS']),
+        "ENERGY_HI": [f"{low}-{high}" for low, high in zip(integers(energy[:, 0]), integers(energy[:, 1]))],
+        "X_POSITION": integers(np.round(position[:, 0])),
+        "Y_POSITION": integers(np.round(position[:, 1])),
+        "POS_RADIAL": integers(np.round(data_frame['POS_RADIAL'].to_numpy(dtype=float))),
+        "ACTIVE_REGION": integers(data_frame['ACTIVE_REGION']),
+        "FLAGS": _flags_formatted(data_frame).tolist(),
+    }
+
+
+def _format_flags(flags, flag_ids):
+    """
+    Convert all rows of a flag array at once into strings of abbreviations (as in available .txt lists).
+    Abbreviations are sorted case-insensitively, attenuator flags are upper case if the attenuator state
+    at peak matches and ``n`` is replaced by the value of the flag.
+
+    Parameters
+    ----------
+    flags : ``numpy.ndarray``
+        2D array with one row per flare and one column per flag id.
+    flag_ids : `list`
+        Flag id of each column.
 
     Returns
     -------
-    `list`
-        out : `list` of 2-character strings, each representing a present flag (as in available .txt lists).
-
+    ``numpy.ndarray``
+        out : array of strings of space separated abbreviations, one per row.
     """
-    flags = []
-    for k in flags_dict:
-        # note: as of now the Q-flag is missing if the flag DATA_QUALITY is 0
-        if flags_dict[k] > 0 and FLAGID2FLAG[k] != '':
-            if k.startswith('ATTEN_') and int(k[-1:]) == flags_dict['ATT_STATE_AT_PEAK']:
-                flags.append(FLAGID2FLAG[k].upper())
-            else:
-                flags.append(FLAGID2FLAG[k].replace("n", str(flags_dict[k])))
-    flags.sort(key=str.lower)
-    return flags
+    flags = np.asarray(flags)
+    att_state = flags[:, flag_ids.index('ATT_STATE_AT_PEAK')] if 'ATT_STATE_AT_PEAK' in flag_ids else None
+
+    columns = []  # (sort key, abbreviation of every row or '' if flag is absent)
+    for j, fid in enumerate(flag_ids):
+        abbr = FLAGID2FLAG[fid]
+        if abbr == '':
+            continue
+        values = flags[:, j]
+        if fid.startswith('ATTEN_'):
+            tokens = np.where(att_state == int(fid[-1:]), abbr.upper(), abbr)
+        elif 'n' in abbr:
+            tokens = np.array([abbr.replace('n', v) for v in values.astype(str).tolist()], dtype=str)
+        else:
+            tokens = np.full(len(values), abbr)
+        columns.append((abbr.lower(), np.where(values > 0, tokens, '').tolist()))
+
+    # all abbreviations differ in lower case, so sorting the columns sorts the abbreviations of every row
+    columns.sort(key=lambda c: c[0])
+    if not columns:
+        return np.full(len(flags), '')
+    return np.array([" ".join(t for t in row if t) for row in zip(*(tokens for _, tokens in columns))], dtype=str)
+
+
+def _flags_formatted(data_frame):
+    # abbreviations of the flag columns of the data frame (as in available .txt lists)
+    flag_ids = [c for c in data_frame.columns if c in FLAGID2FLAG]
+    return _format_flags(data_frame[flag_ids].to_numpy(), flag_ids)
 
 
 def filter_flares_by_time(flares_df, time):
     return flares_df[(flares_df["START_TIME"] < time) & (flares_df["END_TIME"] > time)]
+
+
+def filter_flares_by_flags(flares_df, absent=(), at_least=None, at_most=None):
+    """
+    Select flares by the values of their flags, evaluated on whole columns.
+    E.g. flares without SAA, attenuator state >= 1 and data quality <= 2::
+
+        filter_flares_by_flags(df, absent=["SAA_AT_START", "SAA_AT_END", "SAA_DURING_FLARE"],
+                               at_least={"ATT_STATE_AT_PEAK": 1}, at_most={"DATA_QUALITY": 2})
+
+    Parameters
+    ----------
+    flares_df : ``pandas.DataFrame``
+        Flares as returned by `get_flare_list`.
+    absent : `list`, optional
+        Flag ids that have to be 0.
+    at_least : `dict`, optional
+        Minimum value (inclusive) per flag id.
+    at_most : `dict`, optional
+        Maximum value (inclusive) per flag id.
+
+    Returns
+    -------
+    ``pandas.DataFrame``
+        out : the flares fulfilling all conditions.
+    """
+    at_least = at_least or {}
+    at_most = at_most or {}
+    for fid in list(absent) + list(at_least) + list(at_most):
+        if fid not in FLAGID2FLAG:
+            raise ValueError(f"unknown flag id: {fid}")
+
+    mask = np.ones(len(flares_df), dtype=bool)
+    for fid in absent:
+        mask &= flares_df[fid].to_numpy() == 0
+    for fid, value in at_least.items():
+        mask &= flares_df[fid].to_numpy() >= value
+    for fid, value in at_most.items():
+        mask &= flares_df[fid].to_numpy() <= value
+    return flares_df[mask]
+
+
+class FlareIndex:
+    """
+    Index of flares for repeated lookups by time, built once from the output of `get_flare_list`.
+    Flares are sorted by START_TIME. Since no flare lasts longer than the longest flare in the list,
+    only flares starting within that duration before a requested time can overlap it. They are found by
+    binary search, so a lookup costs O(log n) plus the number of flares within this window.
+    """
+
+    def __init__(self, flares_df):
+        """
+        Parameters
+        ----------
+        flares_df : ``pandas.DataFrame``
+            Flares with (at least) the columns START_TIME and END_TIME.
+        """
+        self.flares = flares_df
+        start = flares_df["START_TIME"].to_numpy(dtype="datetime64[ns]")
+        end = flares_df["END_TIME"].to_numpy(dtype="datetime64[ns]")
+        # flares without START_TIME or END_TIME (NaT) never match, they are left out of the index
+        valid = np.flatnonzero(~(np.isnat(start) | np.isnat(end)))
+        self._order = valid[np.argsort(start[valid], kind="stable")]
+        self._start = start[self._order]
+        self._end = end[self._order]
+        self._max_duration = (self._end - self._start).max() if len(self._order) else np.timedelta64(0, "ns")
+
+    def at(self, time):
+        """ Flares with START_TIME < time < END_TIME, same as `filter_flares_by_time`. """
+        return self.overlapping(time, time)
+
+    def overlapping(self, start, end):
+        """ Flares with START_TIME < end and END_TIME > start, in the order of the indexed frame. """
+        start = _to_datetime64(start)
+        end = _to_datetime64(end)
+        lo = np.searchsorted(self._start, start - self._max_duration, "right")
+        hi = np.searchsorted(self._start, end, "left")
+        candidates = np.arange(lo, max(lo, hi))
+        rows = self._order[candidates[self._end[candidates] > start]]
+        return self.flares.iloc[np.sort(rows)]
+
+    def at_many(self, times):
+        """
+        Looks up many points in time at once.
+
+        Parameters
+        ----------
+        times : array-like
+            Points in time, e.g. the times of all frames of a JHV layer.
+
+        Returns
+        -------
+        `tuple`
+            out : two arrays of equal length, positions in ``times`` and positions (as for ``iloc``) of the
+            flares with START_TIME < time < END_TIME, one entry per match.
+        """
+        times = pd.DatetimeIndex(times).to_numpy(dtype="datetime64[ns]")
+        lo = np.searchsorted(self._start, times - self._max_duration, "right")
+        hi = np.searchsorted(self._start, times, "left")
+        counts = np.maximum(hi - lo, 0)
+
+        # expand the candidate range of every time into (time, flare) pairs without a python loop
+        query = np.repeat(np.arange(len(times)), counts)
+        first = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        candidates = first + np.arange(counts.sum())
+        match = self._end[candidates] > times[query]
+        return query[match], self._order[candidates[match]]
+
+
+def _to_datetime64(time):
+    return pd.Timestamp(time).to_datetime64().astype("datetime64[ns]")
@@ -1,9 +1,14 @@
-from sunpy.io.fits import read
-from sunpy.time import parse_time
+import numpy as np
+from collections import ChainMap
+from types import MappingProxyType
+from astropy.io import fits
+from sunpy.io.fits import format_comments_and_history, header_to_fits
 from sunpy.map import Map
 
+from samp4jhv.ext.rhessi.utime import utime_to_isot
 
-__all__ = ["hsi_fits2map"]
+
+__all__ = ["hsi_fits2map", "HSIImageCube", "HSIFrame"]
 
 
 """ NOTE: as of february 2021 this functionality is part of sunkit-instruments v0.2 as imagecube2map()"""
@@ -12,6 +17,7 @@ def hsi_fits2map(url):
     Extracts single map images from a RHESSI flare image datacube. Currently
     assumes input to be 4D.
     This function is analogous to the `hsi_fits2map.pro` functionality available in SSW.
+    See `HSIImageCube` to only extract the maps that are needed.
     Parameters
     ----------
     rhessi_imagecube_file : `str`
@@ -21,33 +27,212 @@ def hsi_fits2map(url):
     `dict` of `sunpy.map.MapSequence`
         Each energy band has a list of maps where the index of the lists represent the time step
     """
-    f = read(url)
-    header = f[0].header
-    
-    # remove those (non-standard) headers to avoid user warnings (they are 0 anyway)
-    del header["CROTACN1"]
-    del header["CROTACN2"]
-    del header["CROTA"]
-
-    d_min = {}
-    d_max = {}
-    for e in range(len(f[1].data[0]["ENERGY_AXIS"])):
-        d_min[e] = 1e10
-        d_max[e] = -1e10
-        for t in range(len(f[1].data[0]["TIME_AXIS"])):
-            d_min[e] = min(d_min[e], f[0].data[t][e].min())
-            d_max[e] = max(d_max[e], f[0].data[t][e].max())
-
-    maps = {}  # result dictionary
-    for e in range(len(f[1].data[0]["ENERGY_AXIS"])):
-        header["ENERGY_L"] = f[1].data[0]["ENERGY_AXIS"][e][0]
-        header["ENERGY_H"] = f[1].data[0]["ENERGY_AXIS"][e][1]
-        header["DATAMIN"] = d_min[e]
-        header["DATAMAX"] = d_max[e]
-        key = f"{int(header['ENERGY_L'])}-{int(header['ENERGY_H'])} keV"
-        maps[key] = []
-        for t in range(len(f[1].data[0]["TIME_AXIS"])):
-            header["DATE_OBS"] = parse_time(f[1].data[0]["TIME_AXIS"][t][0], format='utime').to_value('isot')
-            header["DATE_END"] = parse_time(f[1].data[0]["TIME_AXIS"][t][1], format='utime').to_value('isot')
-            maps[key].append(Map(f[0].data[t][e], header))  # extract image into sunpy.Map
-    return maps
+    with HSIImageCube(url) as cube:
+        return cube.to_dict()
+
+
+class HSIImageCube:
+    """
+    Lazy view of a RHESSI flare image datacube (4D). The cube is memory-mapped and a map is only
+    built when it is accessed, from a base header shared by all frames.
+
+    ``cube[e, t]`` returns the map of energy band ``e`` (index or key, e.g. ``"6-12 keV"``) at time step ``t``,
+    ``cube[e, t0:t1]`` a list of maps of a time window and ``cube[e]`` all maps of an energy band.
+    `band` and iteration create maps one by one, e.g. for ``SAMP4JHVClient.stream_image_maps``.
+    `frames` yields `HSIFrame` objects instead, which only keep the keywords that change per frame and
+    can be sent to JHV without building maps.
+    Call `close` (or use the cube as context manager) once all needed maps or frames are created, they keep
+    their data after the cube is closed.
+    """
+
+    def __init__(self, url):
+        """
+        Parameters
+        ----------
+        url : `str`
+            Path or URL to image datacube .fits
+        """
+        # memory-mapped: frames are views into the file, that are only read when used.
+        # the file stays open as long as maps reference its data
+        self._file = fits.open(url, memmap=True, ignore_blank=True)
+        self._file.verify('silentfix+warn')
+        self._data = self._file[0].data  # axes are (time, energy, y, x)
+
+        header = format_comments_and_history(self._file[0].header)
+        # remove those (non-standard) headers to avoid user warnings (they are 0 anyway)
+        del header["CROTACN1"]
+        del header["CROTACN2"]
+        del header["CROTA"]
+        self._base_header = MappingProxyType(header)  # shared by all frames, must not be modified
+        self._fits_header = None  # base header converted for FITS writes, see `fits_header`
+
+        axes = self._file[1].data[0]
+        self.energy_axis = np.asarray(axes["ENERGY_AXIS"])
+        self.time_axis = np.asarray(axes["TIME_AXIS"])
+        self.energy_bands = [f"{int(low)}-{int(high)} keV" for low, high in self.energy_axis]
+        # convert times once per time axis instead of once per frame
+        self.date_obs = utime_to_isot(self.time_axis[:, 0])
+        self.date_end = utime_to_isot(self.time_axis[:, 1])
+        self._value_ranges = {}  # energy index -> (min, max) over all time steps
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Closes the file. The memory map stays open until all maps and frames created from it are deleted. """
+        self._data = None
+        self._file.close()
+
+    @property
+    def closed(self):
+        return self._data is None
+
+    @property
+    def _cube(self):
+        if self._data is None:
+            raise ValueError("image cube is closed")
+        return self._data
+
+    @property
+    def shape(self):
+        """ Number of energy bands and time steps. """
+        return len(self.energy_axis), len(self.time_axis)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, key):
+        e, t = key if isinstance(key, tuple) else (key, slice(None))
+        e = self._energy_index(e)
+        if isinstance(t, slice):
+            return [self._map(e, i) for i in range(self.shape[1])[t]]
+        return self._map(e, range(self.shape[1])[t])
+
+    def __iter__(self):
+        for e in range(self.shape[0]):
+            yield from self.band(e)
+
+    def band(self, energy, times=slice(None)):
+        """ Yields the maps of one energy band (index or key), optionally only of a slice of time steps. """
+        e = self._energy_index(energy)
+        for t in range(self.shape[1])[times]:
+            yield self._map(e, t)
+
+    def frames(self, energy, times=slice(None)):
+        """ Yields the `HSIFrame` objects of one energy band (index or key), optionally only of a slice of time steps. """
+        e = self._energy_index(energy)
+        for t in range(self.shape[1])[times]:
+            yield self.frame(e, t)
+
+    def frame(self, energy, t):
+        """ Returns the `HSIFrame` of energy band (index or key) at time step t. """
+        e = self._energy_index(energy)
+        t = range(self.shape[1])[t]
+        d_min, d_max = self.value_range(e)
+        keywords = {
+            "ENERGY_L": self.energy_axis[e][0],
+            "ENERGY_H": self.energy_axis[e][1],
+            "DATAMIN": d_min,
+            "DATAMAX": d_max,
+            "DATE_OBS": str(self.date_obs[t]),
+            "DATE_END": str(self.date_end[t]),
+        }
+        return HSIFrame(self, self._cube[t, e], keywords)
+
+    @property
+    def base_header(self):
+        """ Read-only header shared by all frames. """
+        return self._base_header
+
+    def fits_header(self):
+        """ Base header as ``astropy.io.fits.Header``, converted once for all frames. Do not modify. """
+        if self._fits_header is None:
+            self._fits_header = header_to_fits(dict(self._base_header))
+        return self._fits_header
+
+    def to_dict(self):
+        """ All maps, as returned by `hsi_fits2map`. """
+        # value range of all energy bands in a single reduction
+        d_min = self._cube.min(axis=(0, 2, 3))
+        d_max = self._cube.max(axis=(0, 2, 3))
+        for e in range(self.shape[0]):
+            self._value_ranges.setdefault(e, (d_min[e], d_max[e]))
+        return {self.energy_bands[e]: list(self.band(e)) for e in range(self.shape[0])}
+
+    def value_range(self, energy):
+        """ Minimum and maximum of an energy band over all time steps. """
+        e = self._energy_index(energy)
+        if e not in self._value_ranges:
+            band = self._cube[:, e]
+            self._value_ranges[e] = (band.min(), band.max())
+        return self._value_ranges[e]
+
+    def _energy_index(self, energy):
+        if isinstance(energy, str):
+            try:
+                return self.energy_bands.index(energy)
+            except ValueError:
+                raise KeyError(f"unknown energy band: {energy}, use one of {self.energy_bands}")
+        return range(self.shape[0])[energy]
+
+    def _map(self, e, t):
+        return self.frame(e, t).to_map()
+
+
+class HSIFrame:
+    """
+    Single frame of an `HSIImageCube`: a view of the image data and the few keywords that differ
+    from the base header of the cube. The full header is only assembled on demand.
+    Can be passed to ``SAMP4JHVClient`` in place of a map (without ``downsample`` encoding). Pickled frames
+    (e.g. for ``pool="process"``) carry a copy of their data and the headers instead of the cube.
+    """
+
+    __slots__ = ("cube", "data", "keywords")
+
+    def __init__(self, cube, data, keywords):
+        self.cube = cube
+        self.data = data
+        self.keywords = keywords
+
+    @property
+    def header(self):
+        """ Read-only view of the full header, keywords of the frame take precedence over the base header. """
+        return MappingProxyType(ChainMap(self.keywords, self.cube.base_header))
+
+    @property
+    def meta(self):
+        """ Copy of the full header as `dict`. """
+        return dict(ChainMap(self.keywords, self.cube.base_header))
+
+    def __reduce__(self):
+        cube = _CubeHeaders(dict(self.cube.base_header), self.cube.fits_header())
+        return HSIFrame, (cube, np.asarray(self.data), self.keywords)
+
+    def to_map(self):
+        return Map(self.data, self.meta)  # extract image into sunpy.Map
+
+    def save(self, filepath, **kwargs):
+        """ Writes the frame as FITS file, the header is based on the converted header of the cube. """
+        hdu = fits.PrimaryHDU(self.data, header=self.cube.fits_header())  # header is copied by astropy
+        hdu.header.update(self.keywords)
+        kwargs.setdefault("output_verify", "fix")
+        hdu.writeto(filepath, **kwargs)
+
+
+class _CubeHeaders:
+    """ Headers of an `HSIImageCube`, all a pickled `HSIFrame` needs of its cube. """
+
+    __slots__ = ("base_header", "_fits_header")
+
+    def __init__(self, base_header, fits_header):
+        self.base_header = MappingProxyType(base_header)
+        self._fits_header = fits_header
+
+    def __reduce__(self):
+        return _CubeHeaders, (dict(self.base_header), self._fits_header)
+
+    def fits_header(self):
+        return self._fits_header
@@ -1,10 +1,22 @@
-from requests import get as get_request
-from bs4 import BeautifulSoup
+from requests import get as get_request, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import re
+import sys
+import html
+import json
 import warnings
-from datetime import datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import time
+from urllib.parse import urlsplit
 
 
-__all__ = ["IC_ALGO", "get_image_cube_url", "get_img_preview_url"]
+__all__ = ["IC_ALGO", "get_image_cube_url", "get_img_preview_url", "get_image_cube_urls", "get_img_preview_urls",
+           "ListingCache"]
 
 
 IC_ALGO = {
@@ -17,69 +29,227 @@ IC_ALGO = {
 }
 
 
-def _matching_chars(s1, s2):
-    # calculates how many chars match in s1 and s2
-    m_len = min(len(s1), len(s2))
-    if m_len < 18:
-        return 0
+class ListingCache:
+    """
+    Thread-safe cache of the links of archive directory listings, keyed by URL. Listings older than ``ttl``
+    seconds are fetched again. If ``filename`` is given, listings are loaded from and saved to this JSON file
+    to be reused in later sessions. Listings are fetched over one pooled HTTP session with retries, at most
+    ``max_per_host`` at a time per host, and concurrent requests of the same listing share one fetch.
+    """
+
+    def __init__(self, filename=None, ttl=7 * 86400, session=None, max_per_host=4, retries=3, timeout=30):
+        """
+        Parameters
+        ----------
+        filename : `str`, optional
+            JSON file to persist the listings. Defaults to ``None`` (in memory only).
+        ttl : `float`, optional
+            Seconds a listing is valid. ``None`` keeps listings forever. Defaults to one week.
+        session : ``requests.Session``, optional
+            Session to fetch the listings with. Defaults to a new session with ``retries`` retries.
+        max_per_host : `int`, optional
+            Maximum number of concurrent requests per host. Defaults to ``4``.
+        retries : `int`, optional
+            Retries with exponential backoff of failed requests of the default session. Defaults to ``3``.
+        timeout : `float`, optional
+            Seconds to wait for a response. Defaults to ``30``.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.session = session if session is not None else _session(max_per_host, retries)
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.fetches = 0  # number of listings fetched from the archive
+        self._listings = {}  # url -> {"time": fetch time, "hrefs": links}
+        self._pending = {}  # url -> Future of a fetch in progress
+        self._parsed = {}  # url -> _Listing of the cached links
+        self._hosts = {}  # host -> BoundedSemaphore
+        self._lock = Lock()
+        if filename is not None and os.path.isfile(filename):
+            with open(filename) as f:
+                self._listings = json.load(f)
+
+    def hrefs(self, url):
+        """ Returns the links of the listing at url, fetched only if it is not cached or expired. """
+        with self._lock:
+            entry = self._listings.get(url)
+            if entry is not None and (self.ttl is None or time() - entry["time"] < self.ttl):
+                return entry["hrefs"]
+            future = self._pending.get(url)
+            owner = future is None
+            if owner:
+                future = self._pending[url] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            hrefs = self._fetch(url)
+            future.set_result(hrefs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+        return hrefs
+
+    def listing(self, url):
+        """ Returns the links of the listing at url, prepared for matching (see `hrefs`). """
+        hrefs = self.hrefs(url)
+        with self._lock:
+            listing = self._parsed.get(url)
+            if listing is None or listing.hrefs is not hrefs:
+                listing = self._parsed[url] = _Listing(hrefs)
+        return listing
+
+    def _fetch(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._hosts.setdefault(host, BoundedSemaphore(self.max_per_host))
+        with semaphore:
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                hrefs = list(_iter_hrefs(response.iter_content(chunk_size=2**16)))
+        with self._lock:
+            self.fetches += 1
+            if response.ok:  # error pages are not cached
+                self._listings[url] = {"time": time(), "hrefs": hrefs}
+        return hrefs
+
+    def save(self):
+        """ Writes the listings to ``filename``. """
+        if self.filename is None:
+            return
+        with self._lock:
+            listings = dict(self._listings)
+        tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(listings, f)
+        os.replace(tmp_file, self.filename)
+
+
+def _session(max_connections, retries):
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD"), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retry)
+    session = Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    mc = 0
-    scores = [2] * m_len
-    scores[11], scores[12], scores[16], scores[17] = 1, 1, 1, 1  # minutes give less score
-    for i in range(m_len):
-        mc += scores[i] if s1[i] == s2[i] else 0
-    return mc
 
+_HREF = re.compile(rb"""<a\s[^>]*?href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
 
-def _get_best_matching_subfolder(url, expected_folder, filter_func=lambda x: True):
-    f = get_request(url)
-    soup = BeautifulSoup(f.text, 'html.parser')
 
-    best_match = ''
-    best_score = 0
-    for a in soup.find_all('a'):
-        folder = a.get("href")
-        if not filter_func(folder):
+def _iter_hrefs(chunks):
+    # yields the href attributes of the <a> tags of an html page given as chunks of bytes,
+    # a tag split between two chunks is kept until its chunk is complete
+    rest = b""
+    for chunk in chunks:
+        rest += chunk
+        end = rest.rfind(b"<")
+        if end <= 0:
             continue
+        for m in _HREF.finditer(rest, 0, end):
+            yield html.unescape((m.group(1) or m.group(2) or m.group(3) or b"").decode("latin-1"))
+        rest = rest[end:]
+    for m in _HREF.finditer(rest):
+        yield html.unescape((m.group(1) or m.group(2) or m.group(3) or b"").decode("latin-1"))
+
+
+def _parse_hrefs(page):
+    return list(_iter_hrefs([page.encode("latin-1", errors="replace") if isinstance(page, str) else page]))
+
+
+class _Listing:
+    """ Links of a listing, split once into a matrix of code points (one row per link) for vectorized matching. """
+
+    __slots__ = ("hrefs", "names", "chars", "lengths", "_times")
+
+    def __init__(self, hrefs):
+        self.hrefs = hrefs
+        self.names = np.array(hrefs, dtype=str) if hrefs else np.zeros(0, dtype="U1")
+        self.chars = self.names.view(np.uint32).reshape(len(self.names), self.names.itemsize // 4)
+        self.lengths = np.char.str_len(self.names)
+        self._times = {}  # offset -> (start and end minute of day per link, valid)
+
+    def columns(self, stop):
+        """ First stop columns of the code point matrix, padded with zeros. """
+        if self.chars.shape[1] >= stop:
+            return self.chars[:, :stop]
+        return np.pad(self.chars, ((0, 0), (0, stop - self.chars.shape[1])))
+
+    def times(self, offset):
+        """ Start and end minute of day of links with a HHMM_HHMM pattern at offset, and which links have one. """
+        if offset not in self._times:
+            digits = self.columns(offset + 9)[:, offset:offset + 9].astype(np.int64) - ord("0")
+            digits = digits[:, [0, 1, 2, 3, 5, 6, 7, 8]]
+            hours = digits[:, [0, 4]] * 10 + digits[:, [1, 5]]
+            minutes = digits[:, [2, 6]] * 10 + digits[:, [3, 7]]
+            valid = ((self.lengths >= offset + 9) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+                     & (hours < 24).all(axis=1) & (minutes < 60).all(axis=1))
+            self._times[offset] = (hours * 60 + minutes, valid)
+        return self._times[offset]
+
+
+def _code_points(s):
+    return np.frombuffer(s.encode("utf-32-le"), dtype="<u4")
 
-        score = _matching_chars(folder, expected_folder)
-        if score > best_score:
-            best_match = folder
-            best_score = score
-    return best_match, best_score
 
+def _get_listing(url, listings=None):
+    if listings is None:
+        return _Listing(_parse_hrefs(get_request(url).content))
+    return listings.listing(url)
 
-def _get_largest_timeoverlap_subfolder(url, expected_folder, offset=9):
+
+def _matching_chars(listing, expected):
+    # calculates how many chars of every link of the listing match expected
+    n = len(expected)
+    if n < 18:
+        return np.zeros(len(listing.hrefs), dtype=np.int64)
+
+    weights = np.full(n, 2)
+    weights[[11, 12, 16, 17]] = 1  # minutes give less score
+    m_len = np.minimum(listing.lengths, n)
+    matches = (listing.columns(n) == _code_points(expected)) & (np.arange(n) < m_len[:, None])
+    scores = matches.astype(np.int64) @ weights
+    scores[m_len < 18] = 0
+    return scores
+
+
+def _get_best_matching_subfolder(url, expected_folder, suffix="", listings=None):
+    listing = _get_listing(url, listings)
+    scores = _matching_chars(listing, expected_folder)
+    scores[~np.char.endswith(listing.names, suffix)] = 0
+    if len(scores) == 0 or scores.max() <= 0:
+        return '', 0
+    best = int(np.argmax(scores))  # first of equal scores
+    return listing.hrefs[best], int(scores[best])
+
+
+def _get_largest_timeoverlap_subfolder(url, expected_folder, offset=9, listings=None):
     # gets best matching subfolder based on differences of start- and endtimes
     # offset determines the start of a %H%M_%H%M pattern that determines start and endtime
     # default (9) is for standard pattern yyyymmdd_HHMM_HHMM
-    f = get_request(url)
-    soup = BeautifulSoup(f.text, 'html.parser')
-
-    best_match = ''
-    best_overlap = 0
-    exp_start = datetime.strptime(expected_folder[offset:offset+4], "%H%M")
-    exp_end = datetime.strptime(expected_folder[offset+5:offset+9], "%H%M")
-    for a in soup.find_all('a'):
-        folder = a.get("href")
-        if folder[:offset] != expected_folder[:offset]:
-            continue
-
-        start_max = max(exp_start, datetime.strptime(folder[offset:offset+4], "%H%M"))
-        end_min = min(exp_end, datetime.strptime(folder[offset+5:offset+9], "%H%M"))
-        overlap = (end_min - start_max).total_seconds()
-        if overlap > best_overlap and overlap > 0:
-            best_match = folder
-            best_overlap = overlap
-    return best_match
+    listing = _get_listing(url, listings)
+    exp_start = int(expected_folder[offset:offset+2]) * 60 + int(expected_folder[offset+2:offset+4])
+    exp_end = int(expected_folder[offset+5:offset+7]) * 60 + int(expected_folder[offset+7:offset+9])
+    times, valid = listing.times(offset)
+    valid = valid & (listing.columns(offset) == _code_points(expected_folder[:offset])).all(axis=1)
+    overlap = np.minimum(times[:, 1], exp_end) - np.maximum(times[:, 0], exp_start)
+    overlap = np.where(valid, overlap, 0)
+    if len(overlap) == 0 or overlap.max() <= 0:
+        return ''
+    return listing.hrefs[int(np.argmax(overlap))]  # first of equal overlaps
 
 
-def get_image_cube_url(flare, algo="clean", base_url="https://hesperia.gsfc.nasa.gov/rhessi_extras/imagecube_fits"):
+def get_image_cube_url(flare, algo="clean", base_url="https://hesperia.gsfc.nasa.gov/rhessi_extras/imagecube_fits",
+                       listings=None):
     """ get respective file from gsfc archive
 
     :param flare: flare object, e.g. df.iloc[0]
     :param algo: reconstruction algorithm. one of ALGO_FILENAMES
     :param base_url: base url for image cube archive
+    :param listings: ListingCache to look up archive listings, fetches every listing if None
     :return: url
     """
     y = flare["START_TIME"].strftime("%Y")
@@ -90,13 +260,13 @@ def get_image_cube_url(flare, algo="clean", base_url="https://hesperia.gsfc.nasa
     file_prefix = f"hsi_imagecube_{algo}_{y}{m}{d}_{start}_"
 
     url = f"{base_url}/{y}/{m}/{d}/"
-    match = _get_largest_timeoverlap_subfolder(url, f"{y}{m}{d}_{start}_{end}")
+    match = _get_largest_timeoverlap_subfolder(url, f"{y}{m}{d}_{start}_{end}", listings=listings)
     if match == "":
         warnings.warn(f"no fits folder found for this flare. Check: {url}")
         return ""
     url += match
 
-    match, score = _get_best_matching_subfolder(url, file_prefix, lambda x: x.endswith(".fits"))
+    match, score = _get_best_matching_subfolder(url, file_prefix, ".fits", listings)
     if match == "":
         warnings.warn(f"no image cube fits file found for this flare. Check: {url}")
         return ""
@@ -106,10 +276,48 @@ def get_image_cube_url(flare, algo="clean", base_url="https://hesperia.gsfc.nasa
     return url
 
 
-def get_img_preview_url(fits_url, algo="clean", file_prefix="hsi_image_panels_scaled_"):
+def get_img_preview_url(fits_url, algo="clean", file_prefix="hsi_image_panels_scaled_", listings=None):
     base = fits_url.rsplit("/", 1)[0].replace("/imagecube_fits/", "/flare_images/") + "/" + IC_ALGO[algo] + "/"
-    match, score = _get_best_matching_subfolder(base, file_prefix, lambda x: x.endswith(".jpeg"))
+    match, score = _get_best_matching_subfolder(base, file_prefix, ".jpeg", listings)
     if not match.endswith(".jpeg"):
         print(f"no image preview found for this flare. Check: {base + match}", file=sys.stderr)
         return ""
     return base + match
+
+
+def get_image_cube_urls(flares_df, algo="clean", base_url="https://hesperia.gsfc.nasa.gov/rhessi_extras/imagecube_fits",
+                        listings=None, max_workers=8):
+    """ get image cube urls of all flares concurrently, every archive listing is fetched at most once
+
+    :param flares_df: flares, e.g. from get_flare_list
+    :param algo: reconstruction algorithm. one of ALGO_FILENAMES
+    :param base_url: base url for image cube archive
+    :param listings: ListingCache to use (and save), a new in-memory cache if None
+    :param max_workers: number of flares resolved at the same time
+    :return: pandas.Series of urls ("" if not found) with the index of flares_df
+    """
+    listings = listings if listings is not None else ListingCache()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        urls = list(executor.map(lambda flare: get_image_cube_url(flare, algo, base_url, listings),
+                                 (flare for _, flare in flares_df.iterrows())))
+    listings.save()
+    return pd.Series(urls, index=flares_df.index, dtype=object)
+
+
+def get_img_preview_urls(fits_urls, algo="clean", file_prefix="hsi_image_panels_scaled_", listings=None,
+                         max_workers=8):
+    """ get preview image urls for image cube urls concurrently, e.g. from get_image_cube_urls
+
+    :param fits_urls: pandas.Series of image cube urls, empty urls are skipped
+    :param algo: reconstruction algorithm. one of ALGO_FILENAMES
+    :param file_prefix: prefix of the preview image file names
+    :param listings: ListingCache to use (and save), a new in-memory cache if None
+    :param max_workers: number of urls resolved at the same time
+    :return: pandas.Series of urls ("" if not found) with the index of fits_urls
+    """
+    listings = listings if listings is not None else ListingCache()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        urls = list(executor.map(lambda u: get_img_preview_url(u, algo, file_prefix, listings) if u else "",
+                                 fits_urls))
+    listings.save()
+    return pd.Series(urls, index=fits_urls.index, dtype=object)
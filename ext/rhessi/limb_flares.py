@@ -1,31 +1,177 @@
+import io
 import os
-from datetime import datetime
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from datetime import timedelta
 from requests import get as get_request
+from requests.exceptions import RequestException
 
 
-__all__ = ["read_limb_flares"]
+__all__ = ["read_limb_flares", "load_limb_flares", "calc_is_limb_flare"]
 
 
 DEFAULT_LIMB_FLARE_LOCATION = os.path.join(os.path.dirname(__file__), "limb_flares_combined.txt")
 
+NUMERIC_FIELDS = [f"FIELD_{i}" for i in range(10)]
+STRING_COLUMNS = ["GOES_CLASS", "GOES_CLASS_EST"]
+COLUMNS = ["ID", "BLOCK", "TIME"] + STRING_COLUMNS + ["POS_X", "POS_Y"] + NUMERIC_FIELDS
 
-def read_limb_flares(flare_list=DEFAULT_LIMB_FLARE_LOCATION):
-    # load data
-    if os.path.isfile(flare_list):
+
+def read_limb_flares(flare_list=DEFAULT_LIMB_FLARE_LOCATION, cache_dir=None):
+    """ Times of the limb flares as list of `datetime`, see `load_limb_flares`. """
+    return load_limb_flares(flare_list, cache_dir)["TIME"].dt.to_pydatetime().tolist()
+
+
+def load_limb_flares(flare_list=DEFAULT_LIMB_FLARE_LOCATION, cache_dir=None):
+    """
+    Loads a limb flare catalogue into typed columns. If ``cache_dir`` is given, the parsed catalogue is
+    cached there as ``.npz`` file, that is reused as long as the size and modification time of a local file
+    do not change. Remote catalogues are then only downloaded again if the server reports a change
+    (conditional GET).
+
+    Parameters
+    ----------
+    flare_list : `str`, optional
+        Path or URL of a tab separated catalogue. Defaults to the catalogue shipped with this package.
+    cache_dir : `str`, optional
+        Folder of the cached catalogues, should only be writable by the user.
+        Defaults to ``None`` (no caching, the catalogue is read and parsed on every call).
+
+    Returns
+    -------
+    ``pandas.DataFrame``
+        out : one row per limb flare with the columns ID, BLOCK (catalogue part, IDs restart in every part),
+        TIME, GOES_CLASS, GOES_CLASS_EST, POS_X, POS_Y and FIELD_0 to FIELD_9 (further values of the catalogue,
+        FIELD_0 is only given in the second part). Missing values are NaN or ``"-"``.
+    """
+    local = os.path.isfile(flare_list)
+    if cache_dir is None:
+        if local:
+            with open(flare_list) as tsv:
+                return _parse_limb_flares(tsv.read())
+        response = get_request(flare_list, timeout=30)
+        response.raise_for_status()
+        return _parse_limb_flares(response.text)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    name = f"{os.path.basename(flare_list)}.{hashlib.sha1(flare_list.encode()).hexdigest()[:16]}"
+    data_file = os.path.join(cache_dir, name + ".npz")
+    meta_file = os.path.join(cache_dir, name + ".json")
+
+    meta = None
+    if os.path.isfile(data_file) and os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+    if local:
+        stat = os.stat(flare_list)
+        validator = {"size": stat.st_size, "mtime": stat.st_mtime}
+        if meta is not None and meta["validator"] == validator:
+            return _read_columns(data_file)
         with open(flare_list) as tsv:
-            lines = tsv.read().split("\n")
+            text = tsv.read()
     else:
-        lines = get_request(flare_list).text.split("\n")
+        headers = {}
+        if meta is not None and "ETag" in meta["validator"]:
+            headers["If-None-Match"] = meta["validator"]["ETag"]
+        if meta is not None and "Last-Modified" in meta["validator"]:
+            headers["If-Modified-Since"] = meta["validator"]["Last-Modified"]
+        try:
+            response = get_request(flare_list, headers=headers, timeout=30)
+        except RequestException:
+            if meta is None:
+                raise
+            return _read_columns(data_file)  # source not reachable, use cached catalogue
+        if response.status_code == 304 and meta is not None:
+            return _read_columns(data_file)
+        response.raise_for_status()
+        validator = {k: response.headers[k] for k in ("ETag", "Last-Modified") if k in response.headers}
+        text = response.text
+
+    flares = _parse_limb_flares(text)
+    tmp_file = f"{data_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        # plain arrays only (strings as unicode arrays), so loading never unpickles objects
+        np.savez(f, **{c: flares[c].to_numpy(dtype=str) if c in STRING_COLUMNS else flares[c].to_numpy()
+                       for c in COLUMNS})
+    os.replace(tmp_file, data_file)
+    tmp_file = f"{meta_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"source": flare_list, "validator": validator}, f)
+    os.replace(tmp_file, meta_file)
+    return flares
+
+
+def _read_columns(data_file):
+    with np.load(data_file, allow_pickle=False) as columns:
+        return pd.DataFrame({c: columns[c] for c in COLUMNS}).astype({c: object for c in STRING_COLUMNS})
+
+
+def _parse_limb_flares(text):
+    # the catalogue has two parts, the second one with an estimated GOES class and one more value per flare:
+    # 1, 2002 Mar 07, 17:50:44, C2.5, -961.5, -176.4, 21.4, 11.6, 5.86, 32.0, 10.1, 4.56, -0.4, 0.77, 12,
+    # 1, 2011 Jan 28, 00:57:03, M1.3, M9.3, 937.7, 285.6, 3.7, 20.1, 15.6, 4.73, 18.2, 12.9, 4.33, -1.2, 0.81, 0,
+    cells = pd.read_csv(io.StringIO(text), sep="\t", header=None, names=range(20), dtype=str,
+                        keep_default_na=False, skip_blank_lines=True).fillna("")
+    cells = cells[cells[0].str.isnumeric() & (cells[1].str.len() > 4)].reset_index(drop=True)
+    wide = ((cells != "").sum(axis=1) >= 17).to_numpy()  # second part
+    ids = cells[0].astype(int)
 
-    flares = []
-    for line in lines:
-        cell = line.split(
-            "\t")  # 1, 2002 Mar 07, 17:50:44, C2.5, -961.5, -176.4, 21.4, 11.6, 5.86, 32.0, 10.1, 4.56, -0.4, 0.77, 12,
-        if len(cell) > 2 and cell[0].isnumeric() and len(cell[1]) > 4:
-            flares.append(datetime.strptime(cell[1] + "T" + cell[2], "%Y %b %dT%H:%M:%S"))
+    def column(wide_index, narrow_index=None):
+        values = cells[wide_index] if narrow_index is None else cells[wide_index].where(wide, cells[narrow_index])
+        return values.replace("-", np.nan)
 
+    flares = pd.DataFrame({
+        "ID": ids,
+        "BLOCK": (ids.diff() <= 0).cumsum(),
+        "TIME": pd.to_datetime(cells[1] + " " + cells[2], format="%Y %b %d %H:%M:%S"),
+        "GOES_CLASS": cells[3],
+        "GOES_CLASS_EST": cells[4].where(wide, "-"),
+        "POS_X": pd.to_numeric(column(5, 4)),
+        "POS_Y": pd.to_numeric(column(6, 5)),
+        "FIELD_0": pd.to_numeric(column(7).where(wide, np.nan)),
+    })
+    for i, name in enumerate(NUMERIC_FIELDS[1:]):
+        flares[name] = pd.to_numeric(column(8 + i, 6 + i))
     return flares
 
 
-def calc_is_limb_flare(df):
-    return df
+def calc_is_limb_flare(df, limb_flares=None, tolerance=timedelta(minutes=5), radial_threshold=900):
+    """
+    Marks flares of a flare list that are in the limb flare catalogue or close to the limb.
+
+    Parameters
+    ----------
+    df : ``pandas.DataFrame``
+        Flares, e.g. from `get_flare_list`, with the columns START_TIME and END_TIME (and POS_RADIAL
+        for the radial criterion).
+    limb_flares : iterable of `datetime`, optional
+        Times of the catalogued limb flares. Defaults to ``None`` (TIME of `load_limb_flares`).
+    tolerance : `datetime.timedelta`, optional
+        A catalogued time between START_TIME - tolerance and END_TIME + tolerance matches a flare.
+        Defaults to 5 minutes.
+    radial_threshold : `float`, optional
+        Flares with POS_RADIAL >= radial_threshold (arcsec) are limb flares as well, also if they are
+        not catalogued. Defaults to ``900``, ``None`` to only use the catalogue.
+
+    Returns
+    -------
+    ``pandas.DataFrame``
+        out : copy of df with the boolean column IS_LIMB_FLARE.
+    """
+    if limb_flares is None:
+        limb_flares = load_limb_flares()["TIME"]
+    times = np.sort(pd.DatetimeIndex(limb_flares).to_numpy(dtype="datetime64[ns]"))
+    tolerance = pd.Timedelta(tolerance).to_timedelta64()
+
+    # a flare matches if any catalogued time is within its (widened) time range, NaT never matches
+    start = df["START_TIME"].to_numpy(dtype="datetime64[ns]") - tolerance
+    end = df["END_TIME"].to_numpy(dtype="datetime64[ns]") + tolerance
+    is_limb_flare = np.searchsorted(times, end, "right") > np.searchsorted(times, start, "left")
+    is_limb_flare &= ~(np.isnat(start) | np.isnat(end))
+
+    if radial_threshold is not None and "POS_RADIAL" in df:
+        is_limb_flare |= df["POS_RADIAL"].to_numpy() >= radial_threshold
+    return df.assign(IS_LIMB_FLARE=is_limb_flare)
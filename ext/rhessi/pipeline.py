@@ -0,0 +1,236 @@
+import os
+import shutil
+import hashlib
+import warnings
+from concurrent.futures import Future
+from queue import Queue
+from tempfile import gettempdir
+from threading import Lock, Thread
+from time import perf_counter
+
+from samp4jhv.map_cache import MapCache
+from samp4jhv.ext.rhessi.hsi_fits2map import HSIImageCube
+from samp4jhv.ext.rhessi.image_cubes import ListingCache, get_image_cube_url
+
+
+__all__ = ["ImageCubePipeline", "StageCounters"]
+
+
+STAGES = ("resolve", "download", "extract", "push")
+
+_DONE = object()  # passed down the queues once all workers of a stage are finished
+
+
+class StageCounters:
+    """ Throughput counters of one pipeline stage. """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0  # items that were passed on to the next stage
+        self.skipped = 0  # items without result, e.g. flares without image cube
+        self.failed = 0
+        self.busy = 0.0  # seconds spent in the stage, summed over all workers
+        self.started = None
+        self.finished = None
+        self._lock = Lock()
+
+    @property
+    def elapsed(self):
+        """ Seconds between the first item entering and the last item leaving the stage. """
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else perf_counter()) - self.started
+
+    @property
+    def throughput(self):
+        """ Processed items per second. """
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (f"{self.name}: {self.processed} processed, {self.skipped} skipped, {self.failed} failed, "
+                f"{self.throughput:.2f}/s, {self.workers} workers")
+
+    def _count(self, counter, seconds, start):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.busy += seconds
+            if self.started is None or start < self.started:
+                self.started = start
+            self.finished = max(self.finished or start, start + seconds)
+
+
+class ImageCubePipeline:
+    """
+    Sends the RHESSI image cubes of a flare list to JHV. Finding the cube urls, downloading the cubes,
+    extracting the frames and sending them run as overlapping stages, connected by bounded queues,
+    each with its own number of worker threads. Downloaded cubes are kept in an on-disk cache, a cube needed
+    by several flares is downloaded once. Every energy band of a cube is sent to JHV as one image layer,
+    the cube is closed once all its bands are sent.
+    """
+
+    def __init__(self, client, algo="clean", energy_bands=None, listings=None, cache=None, resolve_workers=8,
+                 download_workers=4, extract_workers=2, push_workers=1, queue_size=4,
+                 base_url="https://hesperia.gsfc.nasa.gov/rhessi_extras/imagecube_fits"):
+        """
+        Parameters
+        ----------
+        client : `SAMP4JHVClient`
+            Client to send the frames to JHV with.
+        algo : `str`, optional
+            Reconstruction algorithm, one of `IC_ALGO`. Defaults to ``"clean"``.
+        energy_bands : `list`, optional
+            Energy bands (keys like ``"6-12 keV"`` or indices) to send. Defaults to ``None`` (all bands).
+        listings : `ListingCache`, optional
+            Cache of the archive listings. Defaults to a new in-memory `ListingCache`.
+        cache : `MapCache`, optional
+            Cache of the downloaded cubes. Defaults to ``samp4jhv_cubes`` in the system temp folder, up to 8 GiB.
+        resolve_workers, download_workers, extract_workers, push_workers : `int`, optional
+            Worker threads per stage. Defaults to ``8``, ``4``, ``2`` and ``1``. More than one push worker
+            sends cubes in parallel, which JHV may then load in a different order.
+        queue_size : `int`, optional
+            Maximum number of items waiting between two stages, limits memory and disk usage. Defaults to ``4``.
+        base_url : `str`, optional
+            Base url of the image cube archive.
+        """
+        self.client = client
+        self.algo = algo
+        self.energy_bands = energy_bands
+        self.listings = listings if listings is not None else ListingCache()
+        self.cache = cache if cache is not None else MapCache(os.path.join(gettempdir(), "samp4jhv_cubes"),
+                                                              max_size=8 * 2**30)
+        self.workers = dict(zip(STAGES, (resolve_workers, download_workers, extract_workers, push_workers)))
+        self.queue_size = queue_size
+        self.base_url = base_url
+        self.counters = {}  # stage -> StageCounters of the last run
+        self._downloads = {}  # cache key -> Future of a download in progress
+        self._lock = Lock()
+
+    def run(self, flares_df):
+        """
+        Sends the image cubes of all flares to JHV and blocks until all stages are finished.
+
+        Parameters
+        ----------
+        flares_df : ``pandas.DataFrame``
+            Flares, e.g. from `get_flare_list`.
+
+        Returns
+        -------
+        `dict`
+            out : `StageCounters` of each stage.
+        """
+        functions = dict(zip(STAGES, (self._resolve, self._download, self._extract, self._push)))
+        self.counters = {s: StageCounters(s, self.workers[s]) for s in STAGES}
+        queues = [Queue(self.queue_size) for _ in STAGES]
+
+        threads = []
+        for i, stage in enumerate(STAGES):
+            out = queues[i + 1] if i + 1 < len(queues) else None
+            workers = [Thread(target=_work, args=(functions[stage], self.counters[stage], queues[i], out),
+                              name=f"samp4jhv-{stage}-{w}", daemon=True) for w in range(self.workers[stage])]
+            threads.append(workers)
+            for t in workers:
+                t.start()
+
+        for _, flare in flares_df.iterrows():
+            queues[0].put(flare)
+        for i, workers in enumerate(threads):
+            for _ in workers:
+                queues[i].put(_DONE)
+            for t in workers:
+                t.join()
+        self.listings.save()
+        return self.counters
+
+    def _resolve(self, flare):
+        url = get_image_cube_url(flare, self.algo, self.base_url, self.listings)
+        return [url] if url else []
+
+    def _download(self, url):
+        # returns the cache key and filename of the cube, the file is in use until released in _push
+        key = hashlib.sha256(url.encode()).hexdigest()
+        while True:
+            filename = self.cache.lookup(key)
+            if filename is not None:
+                if os.path.isfile(filename):
+                    return [(key, filename)]
+                self.cache.release(key)  # removed from outside the cache, download again
+            with self._lock:
+                future = self._downloads.get(key)
+                owner = future is None
+                if owner:
+                    future = self._downloads[key] = Future()
+            if owner:
+                break
+            future.result()  # downloaded by another worker, raises if it failed
+
+        try:
+            filename = self._fetch(url, key)
+            future.set_result(filename)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._downloads.pop(key, None)
+        return [(key, filename)]
+
+    def _fetch(self, url, key):
+        part_filename = self.cache.reserve(key)
+        try:
+            with self.listings.session.get(url, stream=True, timeout=self.listings.timeout) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(part_filename, "wb") as f:
+                    shutil.copyfileobj(response.raw, f)
+        except BaseException:
+            if os.path.exists(part_filename):
+                os.unlink(part_filename)
+            raise
+        return self.cache.commit(key, part_filename)
+
+    def _extract(self, item):
+        key, filename = item
+        try:
+            cube = HSIImageCube(filename)
+        except BaseException:
+            self.cache.release(key)
+            raise
+        try:
+            bands = self.energy_bands if self.energy_bands is not None else range(cube.shape[0])
+            return [(key, cube, [list(cube.frames(e)) for e in bands])]
+        except BaseException:
+            cube.close()
+            self.cache.release(key)
+            raise
+
+    def _push(self, item):
+        key, cube, bands = item
+        try:
+            for frames in bands:
+                self.client.send_image_maps(frames)
+        finally:
+            cube.close()
+            self.cache.release(key)
+        return []
+
+
+def _work(func, counters, in_queue, out_queue):
+    # runs items of in_queue through func and passes each of the results on to out_queue
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            return
+        start = perf_counter()
+        try:
+            results = func(item)
+        except Exception as e:
+            counters._count("failed", perf_counter() - start, start)
+            warnings.warn(f"Skipped: {counters.name} failed ({e})")
+            continue
+        counters._count("processed" if results or out_queue is None else "skipped", perf_counter() - start, start)
+        if out_queue is not None:
+            for r in results:
+                out_queue.put(r)
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+__all__ = ["utime_to_datetime64", "utime_to_isot", "UTIME_EPOCH"]
+
+
+# RHESSI 'utime' counts seconds (without leap seconds) since this date, like Unix time but starting 9 years later
+UTIME_EPOCH = np.datetime64("1979-01-01T00:00:00", "ns")
+
+
+def utime_to_datetime64(utime):
+    """
+    Vectorized conversion of RHESSI 'utime' values, without creating ``astropy.time.Time`` objects.
+    The conversion is linear (86400 seconds per day, no leap seconds) and rounded to microseconds.
+    Mind that this is not the same as ``parse_time(utime, format="utime")``: results differ by up to
+    about 1 s on days with a leap second (e.g. 2005-12-31, 2008-12-31, 2012-06-30) and by up to 1 us of
+    rounding otherwise.
+
+    Parameters
+    ----------
+    utime : array-like
+        Seconds since 1979-01-01, NaN values become NaT.
+
+    Returns
+    -------
+    ``numpy.ndarray``
+        out : array of ``datetime64[ns]``.
+    """
+    return _from_utime(utime, 1e6, "us").astype("datetime64[ns]")
+
+
+def utime_to_isot(utime):
+    """
+    Vectorized conversion of RHESSI 'utime' values to ISO strings with millisecond precision,
+    e.g. ``"2002-02-20T11:06:02.000"``. Linear as `utime_to_datetime64`, so results can differ from
+    ``parse_time(utime, format="utime").to_value('isot')`` on days with a leap second.
+
+    Parameters
+    ----------
+    utime : array-like
+        Seconds since 1979-01-01.
+
+    Returns
+    -------
+    ``numpy.ndarray``
+        out : array of `str`.
+    """
+    return np.datetime_as_string(_from_utime(utime, 1e3, "ms"), unit="ms")
+
+
+def _from_utime(utime, ticks_per_second, unit):
+    utime = np.asarray(utime, dtype=np.float64)
+    nan = np.isnan(utime)
+    ticks = np.round(np.where(nan, 0, utime) * ticks_per_second).astype(np.int64)
+    result = UTIME_EPOCH.astype(f"datetime64[{unit}]") + ticks.astype(f"timedelta64[{unit}]")
+    result[nan] = np.datetime64("NaT")
+    return result
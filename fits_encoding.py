@@ -0,0 +1,70 @@
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from sunpy.io.fits import header_to_fits
+
+
+__all__ = ["encode_map", "COMPRESSION_TYPES", "DTYPES"]
+
+
+COMPRESSION_TYPES = ("RICE_1", "GZIP_1", "GZIP_2", "HCOMPRESS_1", "PLIO_1")
+DTYPES = ("float32", "int16")
+
+INT16_BLANK = -32768  # reserved for NaN values, data is scaled to -32767..32767
+
+
+def encode_map(m, compression=None, dtype=None, downsample=None):
+    """
+    Converts a map into a FITS file with reduced size.
+
+    Parameters
+    ----------
+    m : ``sunpy.map.Map``
+        The map to convert.
+    compression : `str`, optional
+        Tile compression algorithm, one of `COMPRESSION_TYPES`. Mind that floating point data is
+        quantized by astropy when compressed with ``"RICE_1"``. Defaults to ``None`` (no compression).
+    dtype : `str`, optional
+        ``"float32"`` or ``"int16"``. For ``"int16"`` the data is scaled linearly between its minimum and
+        maximum (physical values are kept in BSCALE/BZERO). In both cases DATAMIN and DATAMAX are set, which
+        makes JHV use the full value range. Defaults to ``None`` (keep the datatype of the map).
+    downsample : `int`, optional
+        Averages blocks of ``downsample`` x ``downsample`` pixels. Defaults to ``None`` (full resolution).
+
+    Returns
+    -------
+    ``astropy.io.fits.HDUList``
+        out : FITS file to be written with ``writeto``.
+    """
+    if compression is not None and compression not in COMPRESSION_TYPES:
+        raise ValueError(f"unknown compression: {compression}, use one of {list(COMPRESSION_TYPES)}")
+    if dtype is not None and dtype not in DTYPES:
+        raise ValueError(f"unknown dtype: {dtype}, use one of {list(DTYPES)}")
+
+    if downsample is not None and downsample > 1:
+        m = m.superpixel(u.Quantity([downsample, downsample], u.pix), func=np.mean)
+
+    data = m.data
+    header = header_to_fits(m.meta)
+    if dtype is not None:
+        d_min = float(np.nanmin(data))
+        d_max = float(np.nanmax(data))
+        header["DATAMIN"] = d_min
+        header["DATAMAX"] = d_max
+    if dtype == "float32":
+        data = data.astype(np.float32)
+    elif dtype == "int16":
+        bscale = (d_max - d_min) / 65534 if d_max > d_min else 1.0
+        bzero = d_min + 32767 * bscale
+        data = np.where(np.isnan(data), d_min - bscale, data)  # ends up as INT16_BLANK
+
+    if compression is None:
+        hdu = fits.PrimaryHDU(data, header=header)
+    else:
+        hdu = fits.CompImageHDU(data, header=header, compression_type=compression)
+
+    if dtype == "int16":
+        hdu.scale("int16", bscale=bscale, bzero=bzero)
+        hdu.header["BLANK"] = INT16_BLANK
+
+    return fits.HDUList([hdu] if compression is None else [fits.PrimaryHDU(), hdu])
@@ -0,0 +1,135 @@
+import os
+import hashlib
+from collections import OrderedDict
+from tempfile import gettempdir
+from threading import Lock
+from uuid import uuid4
+
+import numpy as np
+
+
+__all__ = ["MapCache"]
+
+
+class MapCache:
+    """
+    Content-addressed on-disk cache of maps saved as FITS files. A map with the same data and header
+    as a previously sent map reuses the existing file. The least recently used files are removed
+    as soon as the total size exceeds ``max_size``, except files that are in use: every filename returned
+    by `lookup` or `commit` is kept until `release` is called for its key.
+    Mind that JHV might re-read files at some point, so evicted files might not be available in JHV anymore.
+    """
+
+    def __init__(self, directory=None, max_size=2 * 2**30):
+        """
+        Parameters
+        ----------
+        directory : `str`, optional
+            Folder of the cached files. Files of previous sessions in this folder are reused.
+            Defaults to ``samp4jhv_cache`` in the system temp folder.
+        max_size : `int`, optional
+            Maximum total size of the cached files in bytes. Defaults to 2 GiB.
+        """
+        self.directory = directory if directory is not None else os.path.join(gettempdir(), "samp4jhv_cache")
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()  # key -> file size, least recently used first
+        self._pinned = {}  # key -> number of users of the file, see `release`
+        self._lock = Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        existing = [e for e in os.scandir(self.directory)
+                    if e.is_file() and e.name.endswith(".fits") and not e.name.startswith(".")]
+        for e in sorted(existing, key=lambda e: e.stat().st_mtime):
+            self._files[e.name[:-len(".fits")]] = e.stat().st_size
+            self.size += e.stat().st_size
+        self._evict()
+
+    def key(self, m, *extra):
+        """ Returns the hash of the data and header of the map (and any further values that change the file). """
+        data = np.ascontiguousarray(m.data)
+        h = hashlib.sha256()
+        h.update(f"{data.dtype.str}{data.shape}".encode())
+        h.update(data.data)
+        h.update(repr(sorted(m.meta.items(), key=lambda item: item[0])).encode())
+        for e in extra:
+            h.update(repr(e).encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + ".fits")
+
+    def lookup(self, key):
+        """
+        Returns the filename of a cached file or ``None`` if key is not cached. Counts hits and misses.
+        A returned file is in use until `release` is called.
+        """
+        with self._lock:
+            if key not in self._files:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._files.move_to_end(key)
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        filename = self.filename(key)
+        try:
+            os.utime(filename)  # keep lru order for later sessions
+        except FileNotFoundError:
+            pass
+        return filename
+
+    def reserve(self, key):
+        """ Returns a unique filename to write the file of key to, see `commit`. """
+        # hidden while being written, the .fits extension is needed for sunpy to detect the file type
+        return os.path.join(self.directory, f".{key}.{uuid4().hex}.fits")
+
+    def commit(self, key, part_filename):
+        """
+        Moves a file written to a filename from `reserve` into the cache and returns its final filename.
+        The file is in use until `release` is called.
+        """
+        filename = self.filename(key)
+        os.replace(part_filename, filename)
+        size = os.path.getsize(filename)
+        with self._lock:
+            self.size += size - self._files.pop(key, 0)
+            self._files[key] = size
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        self._evict()
+        return filename
+
+    def release(self, key):
+        """ Marks a file returned by `lookup` or `commit` as no longer in use, so it can be evicted. """
+        with self._lock:
+            count = self._pinned.pop(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+        self._evict()
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._files)
+        for key in keys:
+            self._remove(key)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self.size <= self.max_size:
+                    return
+                key = next((k for k in self._files if k not in self._pinned), None)
+                if key is None:
+                    return  # all files in use, evicted once released
+            self._remove(key)
+
+    def _remove(self, key):
+        with self._lock:
+            if key not in self._files:
+                return
+            self.size -= self._files.pop(key)
+        try:
+            os.unlink(self.filename(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,213 @@
+import shutil
+from collections import OrderedDict
+from os import unlink as del_file
+from os.path import getsize
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+from time import time
+from uuid import uuid4
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+__all__ = ["BufferPool", "MapServer"]
+
+
+class BufferPool:
+    """
+    Thread-safe storage of serialized FITS files. Files are kept in memory as long as the total
+    size stays below ``max_memory``, further files are spilled to temporary files on disk.
+    Files that were served at least once are removed (oldest first) to make room for new files
+    when the memory or the spill budget ``max_spill`` is used up, and after ``max_age`` seconds.
+    Files that were not served yet are never removed, so both limits may be exceeded by them.
+    Mind that JHV might re-read files at some point, so removed files might not be available in JHV anymore.
+    """
+
+    def __init__(self, max_memory=256 * 2**20, spill_dir=None, max_spill=2 * 2**30, max_age=None):
+        """
+        Parameters
+        ----------
+        max_memory : `int`, optional
+            Maximum number of bytes kept in memory. Defaults to 256 MiB.
+        spill_dir : `str`, optional
+            Folder for files that do not fit into memory anymore. Defaults to the system temp folder.
+        max_spill : `int`, optional
+            Maximum number of bytes of spilled files. ``None`` for no limit. Defaults to 2 GiB.
+        max_age : `float`, optional
+            Seconds after being served first after which files are removed. Defaults to ``None`` (no limit).
+        """
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.max_spill = max_spill
+        self.max_age = max_age
+        self.memory_size = 0
+        self.spill_size = 0
+        self._memory = {}  # key -> bytes
+        self._spilled = {}  # key -> (filename, size)
+        self._served = OrderedDict()  # key -> time of first request, oldest first
+        self._lock = Lock()
+
+    def put(self, data):
+        """ Stores bytes and returns the key to retrieve them. """
+        self.expire()
+        key = uuid4().hex
+        if self._make_room(self._memory, "memory_size", self.max_memory, len(data)):
+            with self._lock:
+                self._memory[key] = data
+                self.memory_size += len(data)
+            return key
+
+        self._make_room(self._spilled, "spill_size", self.max_spill, len(data))
+        f = NamedTemporaryFile(delete=False, suffix=".fits", dir=self.spill_dir)
+        with f:
+            f.write(data)
+        with self._lock:
+            self._spilled[key] = (f.name, len(data))
+            self.spill_size += len(data)
+        return key
+
+    def expire(self):
+        """ Removes files that were served longer than ``max_age`` seconds ago. """
+        if self.max_age is None:
+            return
+        now = time()
+        with self._lock:
+            expired = [k for k, served in self._served.items() if now - served > self.max_age]
+        for key in expired:
+            self.remove(key)
+
+    def _make_room(self, entries, size_attribute, limit, needed):
+        # removes served entries of entries (oldest first) until needed bytes fit into limit,
+        # returns whether they fit
+        if limit is not None and needed > limit:
+            return False
+        while True:
+            with self._lock:
+                if limit is None or getattr(self, size_attribute) + needed <= limit:
+                    return True
+                key = next((k for k in self._served if k in entries), None)
+            if key is None:
+                return False
+            self.remove(key)
+
+    def size(self, key):
+        """ Returns the number of bytes stored under key, raises `KeyError` for unknown keys. """
+        with self._lock:
+            if key in self._memory:
+                return len(self._memory[key])
+            return getsize(self._spilled[key][0])
+
+    def copy_to(self, key, out):
+        """ Writes the bytes stored under key to the file-like object out. """
+        with self._lock:
+            data = self._memory.get(key)
+            filename = self._spilled.get(key, (None, 0))[0]
+        if data is not None:
+            out.write(data)
+        elif filename is not None:
+            with open(filename, "rb") as f:
+                shutil.copyfileobj(f, out)
+        else:
+            raise KeyError(key)
+        with self._lock:
+            if key in self._memory or key in self._spilled:
+                self._served.setdefault(key, time())
+
+    def remove(self, key):
+        with self._lock:
+            data = self._memory.pop(key, None)
+            filename, size = self._spilled.pop(key, (None, 0))
+            self._served.pop(key, None)
+            if data is not None:
+                self.memory_size -= len(data)
+            self.spill_size -= size
+        if filename is not None:
+            try:
+                del_file(filename)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._memory) + list(self._spilled)
+        for key in keys:
+            self.remove(key)
+
+
+class MapServer:
+    """ Minimal local HTTP server that serves the content of a `BufferPool` to JHV. """
+
+    def __init__(self, pool=None, host="127.0.0.1", port=0):
+        """
+        Parameters
+        ----------
+        pool : `BufferPool`, optional
+            Storage of the files to serve. Defaults to a new `BufferPool`.
+        host : `str`, optional
+            Address to bind to. Defaults to ``"127.0.0.1"``.
+        port : `int`, optional
+            Port to bind to. Defaults to ``0`` (any free port).
+        """
+        self.pool = pool if pool is not None else BufferPool()
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._server is not None
+
+    def start(self):
+        if self.is_running:
+            return
+        self._server = ThreadingHTTPServer((self.host, self.port), _BufferPoolRequestHandler)
+        self._server.daemon_threads = True
+        self._server.pool = self.pool
+        self._thread = Thread(target=self._server.serve_forever, name="samp4jhv-map-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def add(self, data):
+        """ Stores bytes of a FITS file and returns the URL under which it is served. """
+        self.start()
+        key = self.pool.put(data)
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/{key}.fits"
+
+
+class _BufferPoolRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        key = self.path.lstrip("/").split("?", 1)[0]
+        key = key[:-len(".fits")] if key.endswith(".fits") else key
+        try:
+            size = self.server.pool.size(key)
+        except (KeyError, FileNotFoundError):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/fits")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if send_body:
+            try:
+                self.server.pool.copy_to(key, self.wfile)
+            except (KeyError, FileNotFoundError):
+                pass  # removed in the meantime, client gets a truncated response
+
+    def log_message(self, format, *args):
+        pass  # keep the console of interactive sessions clean
@@ -1,39 +1,290 @@
-from os import unlink as del_file
-from tempfile import NamedTemporaryFile
-from astropy.samp import SAMPIntegratedClient
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+from time import perf_counter
+from astropy.io import fits
+from astropy.samp import SAMPIntegratedClient, SAMPHubError, SAMPProxyError, SAMPClientError
+from sunpy.io.fits import header_to_fits
+
+from samp4jhv.fits_encoding import encode_map
+from samp4jhv.map_server import BufferPool, MapServer
+from samp4jhv.tmp_storage import TempStorage
 
 
 __all__ = ["SAMP4JHVClient"]
 
 
 class SAMP4JHVClient:
-    def __init__(self):
-        self.client = SAMPIntegratedClient()
-        self.tmp_files = []
+    def __init__(self, keep_alive=False, client=None, workers=None, pool="thread", max_in_flight=None,
+                 transfer="file", max_memory=256 * 2**20, spill_dir=None, cache=None,
+                 storage=None, encoding=None, max_spill=2 * 2**30):
+        """
+        Parameters
+        ----------
+        keep_alive : `bool`, optional
+            If ``True`` the hub connection is kept open after the first message until `close` is called.
+            Otherwise every call connects to and disconnects from the hub (default).
+        client : ``SAMPIntegratedClient``, optional
+            Client to be used to talk to the hub, e.g. one registered to a local test hub.
+        workers : `int`, optional
+            Number of maps written to disk in parallel. Defaults to ``None`` (write one after another).
+        pool : `str`, optional
+            Either ``"thread"`` or ``"process"``. Defaults to ``"thread"``.
+        max_in_flight : `int`, optional
+            Maximum number of maps submitted to the pool but not yet written, limits memory usage.
+            Defaults to ``2 * workers``.
+        transfer : `str`, optional
+            ``"file"`` writes every map to a temporary file (default). ``"http"`` keeps the FITS bytes in
+            memory and serves them to JHV from a local HTTP server, see `MapServer`.
+        max_memory : `int`, optional
+            Only for ``transfer="http"``: bytes kept in memory before further maps are spilled to disk.
+            Defaults to 256 MiB.
+        spill_dir : `str`, optional
+            Only for ``transfer="http"``: folder for spilled maps. Defaults to the system temp folder.
+        max_spill : `int`, optional
+            Only for ``transfer="http"``: bytes of spilled maps, maps that were already loaded by JHV are removed
+            to stay below. Also maps in memory make room for new maps once loaded. Defaults to 2 GiB.
+        cache : `MapCache`, optional
+            Only for ``transfer="file"``: reuse files of maps that were sent before instead of writing
+            new temporary files. Defaults to ``None`` (no caching).
+        storage : `TempStorage`, optional
+            Only for ``transfer="file"``: manages the temporary files, e.g. to limit their age and total size.
+            Defaults to a `TempStorage` without limits that keeps its files until `remove_tmp_files` is called.
+        encoding : `dict`, optional
+            Keyword arguments of `encode_map` to write smaller files, e.g. ``{"compression": "RICE_1",
+            "dtype": "int16"}``. Defaults to ``None`` (write maps as they are).
+        """
+        if pool not in POOLS:
+            raise ValueError(f"unknown pool: {pool}, use one of {list(POOLS)}")
+        if transfer not in ("file", "http"):
+            raise ValueError(f"unknown transfer: {transfer}, use one of ['file', 'http']")
+        self.client = client if client is not None else SAMPIntegratedClient()
+        self.storage = storage if storage is not None else TempStorage(remove_at_exit=False)
+        self.keep_alive = keep_alive
+        self.workers = workers
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.transfer = transfer
+        self.server = MapServer(BufferPool(max_memory, spill_dir, max_spill)) if transfer == "http" else None
+        self.cache = cache
+        self.encoding = dict(encoding) if encoding else None
+        self.latencies = []  # seconds per sent message, in order of sending
+        self._unsent_files = []  # written but not yet sent, in use until the notification is sent
+        self._unsent_keys = []  # cache keys of files to be sent, pinned in the cache until then
+        self._session = False  # connection kept between `open` and `close`, independent of keep_alive
+
+    @property
+    def tmp_files(self):
+        """ Temporary files that were created for JHV to be read and were not removed yet. """
+        return self.storage.files
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """ Registers with the hub once and keeps the connection alive until `close` is called. """
+        self._session = True
+        if not self.client.is_connected:
+            self.client.connect()
+
+    def close(self):
+        """ Ends a session started with `open` and unregisters from the hub. The keep_alive mode is not changed. """
+        self._session = False
+        self._disconnect()
 
     def send_image_maps(self, maps):
-        """ Takes a list of SunPy Map objects, saves them to disk one by one and sends the file-locations to JHV """
-        
+        """ Takes a list of SunPy Map objects, saves them to disk (or memory) and sends their locations to JHV """
+
         params = {}
-        params["url"] = []
-        for m in maps:
-            f = NamedTemporaryFile(delete=False, suffix=".fits")
-            f.close()
-            m.save(f.name)
-            self.tmp_files.append(f.name)
-            # use file:/// workaround for windows as JHV currently can't handle windows paths
-            params["url"].append(("file:///" + f.name.replace("\\", "/")) if f.name.find("\\") >= 0 else f.name)
-
-        self.client.connect()
-        self.client.notify_all({"samp.mtype": "jhv.load.image", "samp.params": params})
-        self.client.disconnect()
+        try:
+            params["url"] = list(self._write_maps(maps))
+            return self._send_urls(params["url"])
+        finally:
+            self._release_unsent()  # only left if writing failed
+
+    def stream_image_maps(self, maps, chunk_size=10):
+        """
+        Sends maps to JHV while they are produced. Every ``chunk_size`` written maps are sent as one
+        ``jhv.load.image`` notification, so JHV can start loading the first frames while later ones are
+        still being computed and written.
+
+        Parameters
+        ----------
+        maps : iterable of ``sunpy.map.Map``
+            Any iterable or generator of maps, e.g. created on the fly from an image cube.
+        chunk_size : `int`, optional
+            Number of maps per notification. Defaults to ``10``.
+
+        Returns
+        -------
+        `list`
+            out : latency in seconds of each sent notification.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+
+        session = self._session
+        self._session = True  # one registration for the whole stream
+        latencies = []
+        try:
+            urls = []
+            for url in self._write_maps(maps):
+                urls.append(url)
+                if len(urls) >= chunk_size:
+                    latencies.append(self._send_urls(urls))
+                    urls = []
+            if urls:
+                latencies.append(self._send_urls(urls))
+        finally:
+            self._release_unsent()
+            self._session = session
+            if not self._stay_connected():
+                self._disconnect()
+        return latencies
 
     def remove_tmp_files(self):
         """ Removes temporary files that were created for JHV to be read.
         Mind that after calling this function, the images might not be available in JHV anymore
         due to JHVs internal memory management, that might require to re-read the files at some point.
         """
-        
-        for f in self.tmp_files:
-            del_file(f)  # cleanup
 
+        self.storage.clear()
+        if self.server is not None:
+            self.server.stop()
+            self.server.pool.clear()
+
+    def _write_maps(self, maps):
+        # saves maps to temporary files and yields their urls in the order of the input maps
+        if not self.workers or self.workers <= 1:
+            for m in maps:
+                func, args, finish = self._writer(m)
+                yield finish(func(*args))
+            return
+
+        max_in_flight = self.max_in_flight or 2 * self.workers
+        with POOLS[self.pool](max_workers=self.workers) as executor:
+            pending = deque()
+            for m in maps:
+                func, args, finish = self._writer(m)
+                pending.append((finish, executor.submit(func, *args)))
+                if len(pending) >= max_in_flight:
+                    finish, future = pending.popleft()
+                    yield finish(future.result())
+            while pending:
+                finish, future = pending.popleft()
+                yield finish(future.result())
+
+    def _writer(self, m):
+        # returns the function serializing m (possibly run in a pool), its arguments
+        # and a callback turning the function result into the url for JHV
+        if self.transfer == "http":
+            return _fits_bytes, (m, self.encoding), self.server.add
+        if self.cache is not None:
+            return self._cached_writer(m)
+        filename = self.storage.new_file(suffix=".fits")
+        return _save_map, (m, filename, self.encoding), lambda _: self._written(filename)
+
+    def _cached_writer(self, m):
+        key = self.cache.key(m, sorted(self.encoding.items()) if self.encoding else None)
+        filename = self.cache.lookup(key)
+        if filename is not None:
+            # released after the notification carrying this url, like files from `_committed`
+            return _noop, (), lambda _: self._cached(key, filename)
+        part_filename = self.cache.reserve(key)
+        return _save_map, (m, part_filename, self.encoding), lambda _: self._committed(key, part_filename)
+
+    def _committed(self, key, part_filename):
+        return self._cached(key, self.cache.commit(key, part_filename))
+
+    def _cached(self, key, filename):
+        self._unsent_keys.append(key)
+        return _file_url(filename)
+
+    def _written(self, filename):
+        self._unsent_files.append(filename)
+        return _file_url(filename)
+
+    def _send_urls(self, urls):
+        try:
+            return self._notify_all({"samp.mtype": "jhv.load.image", "samp.params": {"url": urls}})
+        finally:
+            self._release_unsent()
+
+    def _release_unsent(self):
+        for f in self._unsent_files:
+            self.storage.release(f)
+        self._unsent_files = []
+        for key in self._unsent_keys:
+            self.cache.release(key)
+        self._unsent_keys = []
+
+    def _notify_all(self, message):
+        # sends message to all clients and returns the latency in seconds (connection setup excluded)
+        if not self.client.is_connected:
+            self.client.connect()
+        try:
+            start = perf_counter()
+            try:
+                self.client.notify_all(message)
+            except (SAMPHubError, SAMPProxyError, SAMPClientError, OSError):
+                # hub was most likely restarted: drop the stale registration and try once more
+                self._disconnect()
+                self.client.connect()
+                start = perf_counter()
+                self.client.notify_all(message)
+            latency = perf_counter() - start
+        finally:
+            if not self._stay_connected():
+                self._disconnect()
+
+        self.latencies.append(latency)
+        return latency
+
+    def _stay_connected(self):
+        return self.keep_alive or self._session
+
+    def _disconnect(self):
+        if not self.client.is_connected:
+            return
+        try:
+            self.client.disconnect()
+        except (SAMPHubError, SAMPProxyError, SAMPClientError, OSError):
+            pass  # hub already gone, nothing left to unregister from
+
+
+POOLS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+
+def _save_map(m, filename, encoding=None):
+    # module level to be usable with a process pool
+    if encoding:
+        encode_map(m, **encoding).writeto(filename, output_verify="fix", overwrite=True)
+    else:
+        m.save(filename)
+
+
+def _noop():
+    pass
+
+
+def _fits_bytes(m, encoding=None):
+    # same FITS content as m.save() or encode_map() would write, but kept in memory
+    buffer = BytesIO()
+    if encoding:
+        hdus = encode_map(m, **encoding)
+    else:
+        hdus = fits.PrimaryHDU(m.data, header=header_to_fits(m.meta))
+    hdus.writeto(buffer, output_verify="fix")
+    return buffer.getvalue()
+
+
+def _file_url(filename):
+    # use file:/// workaround for windows as JHV currently can't handle windows paths
+    return ("file:///" + filename.replace("\\", "/")) if filename.find("\\") >= 0 else filename
@@ -0,0 +1,143 @@
+import os
+import shutil
+import weakref
+from tempfile import mkdtemp, NamedTemporaryFile
+from threading import Event, Lock, Thread
+from time import time
+
+
+__all__ = ["TempStorage"]
+
+
+class TempStorage:
+    """
+    Temporary files of one session, kept in a dedicated folder. Files that are in use (see `new_file` and
+    `release`) are never removed. Released files are removed as soon as they are older than ``max_age``
+    or the total size exceeds ``max_bytes`` (oldest first), by a background thread every ``interval`` seconds.
+    Mind that JHV might re-read files at some point, so removed files might not be available in JHV anymore.
+    """
+
+    def __init__(self, directory=None, max_age=None, max_bytes=None, interval=60.0, remove_at_exit=True):
+        """
+        Parameters
+        ----------
+        directory : `str`, optional
+            Parent folder of the session folder. Defaults to the system temp folder.
+        max_age : `float`, optional
+            Seconds after which released files are removed. Defaults to ``None`` (no limit).
+        max_bytes : `int`, optional
+            Maximum total size of released files. Defaults to ``None`` (no limit).
+        interval : `float`, optional
+            Seconds between two cleanups in the background. Defaults to ``60``.
+        remove_at_exit : `bool`, optional
+            Remove the session folder when the storage is garbage collected or the interpreter exits.
+            Defaults to ``True``.
+        """
+        self.parent_directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.remove_at_exit = remove_at_exit
+        self.directory = None  # created with the first file
+        self._files = {}  # filename -> [creation time, references], in order of creation
+        self._lock = Lock()
+        self._stop = Event()
+        self._finalizer = None
+
+        if max_age is not None or max_bytes is not None:
+            # the thread only holds a weak reference to allow garbage collection of the storage
+            Thread(target=_cleanup_loop, args=(weakref.ref(self), self._stop, interval),
+                   name="samp4jhv-tmp-cleanup", daemon=True).start()
+
+    @property
+    def files(self):
+        with self._lock:
+            return list(self._files)
+
+    def new_file(self, suffix=".fits"):
+        """ Creates an empty file that is in use until `release` is called and returns its name. """
+        with self._lock:
+            if self.directory is None:
+                self.directory = mkdtemp(prefix="samp4jhv_", dir=self.parent_directory)
+                if self.remove_at_exit:
+                    self._finalizer = weakref.finalize(self, _remove_session, self.directory, self._stop)
+            f = NamedTemporaryFile(delete=False, suffix=suffix, dir=self.directory)
+            f.close()
+            self._files[f.name] = [time(), 1]
+        return f.name
+
+    def release(self, filename):
+        """ Marks a file as no longer in use, so it can be removed by the cleanup. """
+        with self._lock:
+            if filename in self._files:
+                self._files[filename][1] = max(0, self._files[filename][1] - 1)
+
+    def cleanup(self):
+        """ Removes released files that exceed the age or size limits. Returns the number of removed files. """
+        now = time()
+        with self._lock:
+            released = [(f, created) for f, (created, refs) in self._files.items() if refs == 0]
+
+        expired = []
+        sizes = []
+        for f, created in released:
+            if self.max_age is not None and now - created > self.max_age:
+                expired.append(f)
+            else:
+                sizes.append((f, _size(f)))
+        if self.max_bytes is not None:
+            total = sum(s for f, s in sizes)
+            for f, s in sizes:  # oldest first
+                if total <= self.max_bytes:
+                    break
+                expired.append(f)
+                total -= s
+
+        for f in expired:
+            self.remove(f)
+        return len(expired)
+
+    def remove(self, filename):
+        with self._lock:
+            self._files.pop(filename, None)
+        try:
+            os.unlink(filename)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """ Removes all files, also those in use. """
+        for f in self.files:
+            self.remove(f)
+
+    def close(self):
+        """ Stops the background cleanup and removes the session folder with all files. """
+        self._stop.set()
+        with self._lock:
+            self._files.clear()
+            directory, self.directory = self.directory, None
+        if self._finalizer is not None:
+            self._finalizer()
+        elif directory is not None:
+            _remove_session(directory, self._stop)
+
+
+def _size(filename):
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return 0
+
+
+def _cleanup_loop(storage_ref, stop, interval):
+    while not stop.wait(interval):
+        storage = storage_ref()
+        if storage is None:
+            return
+        storage.cleanup()
+        del storage
+
+
+def _remove_session(directory, stop):
+    stop.set()
+    shutil.rmtree(directory, ignore_errors=True)